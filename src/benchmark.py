@@ -0,0 +1,354 @@
+'''
+Performance benchmarks of the simulation, the MDP solvers and the learners
+
+Run all benchmarks on the worlds files and synthetic larger maps, save the results:
+    python benchmark.py run -o results.json
+Compare two results files, exit with code 1 if a benchmark got slower than the threshold:
+    python benchmark.py compare old.json new.json
+Check that the vectorized learners (VecWorld) stay close to the serial ones, exit with code 1 if not:
+    python benchmark.py check
+
+Every run starts with the same seeds. The first warmup run is traced with tracemalloc
+to get the peak memory, the next ones are timed
+'''
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import mdp2
+import monte_carlo
+from policy import Policy
+import td_learning
+import vec_world
+import world
+
+
+'''
+Write a synthetic world of width * height cells in directory, return its path
+Walls on a regular grid of pillars (every cell stays reachable), some holes,
+a goal in the bottom right corner, apples and 2 ghosts
+'''
+def synthetic_world(directory, width, height, seed = 0):
+    rng = np.random.RandomState(seed)
+    rows = []
+    for y in range(height):
+        row = ''
+        for x in range(width):
+            if x % 2 == 1 and y % 2 == 1:
+                row += 'W'
+            else:
+                row += rng.choice(['.', 'A', 'H'], p=[0.89, 0.1, 0.01])
+        rows.append(row)
+
+    def put(x, y, code):
+        rows[y] = rows[y][:x] + code + rows[y][x + 1:]
+
+    put(0, 0, 'S')
+    put(width - 1, height - 1, 'G')
+    put(width // 2 & ~1, height // 2 & ~1, '2')
+    put((width // 2 & ~1) + 2, height // 2 & ~1, '3')
+
+    path = os.path.join(directory, 'synthetic_{}x{}.world'.format(width, height))
+    with open(path, 'w') as f:
+        f.write('MAP = {} * {}\n'.format(width, height))
+        f.write('\n'.join(rows) + '\n')
+        f.write('PROBA_ACTION_VALID = 0.8\n')
+    return path
+
+
+def bench_world_load(path, w, args):
+    world.World(path)
+    return 1, 'loads'
+
+def bench_take_action(path, w, args):
+    steps = 0
+    while steps < args.steps:
+        w.reset()
+        while not w.finished and steps < args.steps:
+            w.take_action(random.randint(0, 3))
+            steps += 1
+    return steps, 'steps'
+
+def bench_mdp_build(path, w, args):
+    mdp2.MDP(w, 0.9)
+    return 1, 'builds'
+
+def bench_value_iteration(path, w, args):
+    model = mdp2.MDP(w, 0.9)
+    _, sweeps, _ = model.value_iteration(args.iters)
+    return sweeps * w.width * w.height, 'backups'
+
+def bench_ipe(path, w, args):
+    model = mdp2.MDP(w, 0.9)
+    _, it, _ = model.iterative_policy_evaluation(random_policy(w), args.iters)
+    return it * w.width * w.height, 'backups'
+
+def bench_policy_iteration(path, w, args):
+    model = mdp2.MDP(w, 0.9)
+    model.policy_iteration(tol=1e-6)
+    return 1, 'solves'
+
+def bench_fvmc(path, w, args):
+    monte_carlo.policy_evaluation_first_visit(w, random_policy(w), args.games, 0.9)
+    return args.games, 'games'
+
+def bench_td0(path, w, args):
+    td_learning.policy_evaluation_td0(w, random_policy(w), 0.1, args.games, 0.9)
+    return args.games, 'games'
+
+def bench_sarsa(path, w, args):
+    td_learning.sarsa(w, 0.1, args.games, 0.9)
+    return args.games, 'games'
+
+def bench_qlearn(path, w, args):
+    td_learning.sarsa_offline(w, 0.1, args.games, 0.9)
+    return args.games, 'games'
+
+def random_policy(w):
+    return Policy(np.full((w.width * w.height, 4), 1. / 4.))
+
+BENCHMARKS = {
+    'world_load': bench_world_load,
+    'take_action': bench_take_action,
+    'mdp_build': bench_mdp_build,
+    'value_iteration': bench_value_iteration,
+    'ipe': bench_ipe,
+    'policy_iteration': bench_policy_iteration,
+    'fvmc': bench_fvmc,
+    'td0': bench_td0,
+    'sarsa': bench_sarsa,
+    'qlearn': bench_qlearn,
+}
+
+
+'''
+Run fn once, starting from seed
+Return (elapsed time, units done, unit name, peak memory if traced)
+'''
+def run_once(fn, path, w, args, trace):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    w.reset()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    units, unit = fn(path, w, args)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, units, unit, peak
+
+'''
+Run a benchmark on a world: warmup runs, then repeats timed runs
+'''
+def run_benchmark(name, path, args):
+    fn = BENCHMARKS[name]
+    w = world.World(path)
+    peak = None
+    for i in range(args.warmup):
+        _, _, _, p = run_once(fn, path, w, args, i == 0)
+        peak = p if i == 0 else peak
+
+    times = []
+    for _ in range(args.repeats):
+        elapsed, units, unit, _ = run_once(fn, path, w, args, False)
+        times.append(elapsed)
+
+    median = float(np.median(times))
+    return {
+        'world': os.path.splitext(os.path.basename(path))[0],
+        'benchmark': name,
+        'states': w.width * w.height,
+        'times': times,
+        'time': median,
+        'min_time': min(times),
+        'units': units,
+        'unit': unit,
+        'throughput': units / median if median > 0 else None,
+        'peak_memory': peak,
+    }
+
+def run(args):
+    paths = args.worlds or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         '..', 'worlds', '*.world')))
+    tmp = tempfile.mkdtemp()
+    for size in args.sizes:
+        paths.append(synthetic_world(tmp, size, size, args.seed))
+    names = args.benchmarks or list(BENCHMARKS)
+
+    results = []
+    for path in paths:
+        for name in names:
+            res = run_benchmark(name, path, args)
+            results.append(res)
+            print('{:<20} {:<18} {:>10.4f} s  {:>14.1f} {}/s'.format(
+                res['world'], name, res['time'], res['throughput'] or 0, res['unit']))
+    shutil.rmtree(tmp)
+
+    out = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'warmup': args.warmup,
+            'repeats': args.repeats,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=2)
+
+'''
+Compare the median times of two results files
+A benchmark is a regression when new time > old time * (1 + threshold)
+'''
+def compare(args):
+    with open(args.old) as f:
+        old = {(r['world'], r['benchmark']): r for r in json.load(f)['results']}
+    with open(args.new) as f:
+        new = {(r['world'], r['benchmark']): r for r in json.load(f)['results']}
+
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key]['time'] / old[key]['time'] if old[key]['time'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+        print('{:<20} {:<18} {:>10.4f} s -> {:>10.4f} s  x{:<6.2f} {}'.format(
+            key[0], key[1], old[key]['time'], new[key]['time'], ratio, flag))
+
+    for key in sorted(set(old) ^ set(new)):
+        print('{:<20} {:<18} only in {}'.format(key[0], key[1],
+                                                  args.old if key in old else args.new))
+
+    return 1 if regressions > 0 else 0
+
+#worlds of the check, the serial learners are slow on the game_* worlds
+CHECK_WORLDS = ['test', 'world1', 'world2']
+
+'''
+Compare the vectorized learners to the serial ones on each world
+td0: mean |V_vec(s) - V(s)| over the visited states, relative to the mean |V(s)|
+qlearn: difference of max |Q|, relative to the serial one
+Values are noisy, the tolerance only catches learners that drift away (divergence)
+'''
+def check(args):
+    paths = args.worlds or [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'worlds', name + '.world') for name in CHECK_WORLDS]
+    failures = 0
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        w = world.World(path)
+        n = w.width * w.height
+
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        vs = td_learning.policy_evaluation_td0(w, random_policy(w), args.alpha, args.games, args.gamma)
+        vw = vec_world.VecWorld(path, args.envs, args.seed)
+        vs_vec = td_learning.policy_evaluation_td0_vec(vw, random_policy(w), args.alpha,
+                                                       args.games, args.gamma)
+        visited = (vs != 0) | (vs_vec != 0)
+        error = np.mean(np.abs(vs_vec - vs)[visited]) / max(np.mean(np.abs(vs[visited])), 1e-12)
+        failures += report(name, 'td0', error, args.tolerance)
+
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        Q = np.zeros((n, 4))
+        td_learning.sarsa_offline(w, args.alpha, args.games, args.gamma, Q)
+        vw = vec_world.VecWorld(path, args.envs, args.seed)
+        Q_vec = np.zeros((n, 4))
+        td_learning.sarsa_offline_vec(vw, args.alpha, args.games, args.gamma, Q_vec)
+        error = abs(np.max(np.abs(Q_vec)) - np.max(np.abs(Q))) / max(np.max(np.abs(Q)), 1e-12)
+        failures += report(name, 'qlearn', error, args.tolerance)
+
+    return 1 if failures > 0 else 0
+
+def report(name, learner, error, tolerance):
+    failed = not error <= tolerance
+    print('{:<20} {:<18} error = {:<10.4f} {}'.format(name, learner, error,
+                                                      'FAILED' if failed else 'ok'))
+    return int(failed)
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: {}'.format(value))
+    return value
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest='command')
+
+parser_run = subparsers.add_parser('run', help='run the benchmarks')
+parser_run.add_argument('-o', '--output', help='results file, default is bench.json',
+                        default='bench.json')
+parser_run.add_argument('--worlds', help='worlds files, default is all worlds/*.world',
+                        nargs='*')
+parser_run.add_argument('--sizes', help='sizes of the synthetic square maps, default is 64 128',
+                        type=int, nargs='*', default=[64, 128])
+parser_run.add_argument('--benchmarks', help='benchmarks to run: ' + ', '.join(BENCHMARKS),
+                        nargs='*', choices=list(BENCHMARKS))
+parser_run.add_argument('--warmup', help='number of warmup runs, default is 1',
+                        type=int, default=1)
+parser_run.add_argument('--repeats', help='number of timed runs, at least 1, default is 3',
+                        type=positive_int, default=3)
+parser_run.add_argument('--seed', help='seed of the random generators, default is 0',
+                        type=int, default=0)
+parser_run.add_argument('--steps', help='number of steps for take_action, default is 20000',
+                        type=int, default=20000)
+parser_run.add_argument('--games', help='number of games for the learners, default is 20',
+                        type=int, default=20)
+parser_run.add_argument('--iters', help='number of sweeps for value_iteration and ipe, default is 100',
+                        type=int, default=100)
+
+parser_compare = subparsers.add_parser('compare', help='compare two results files')
+parser_compare.add_argument('old', help='reference results file')
+parser_compare.add_argument('new', help='new results file')
+parser_compare.add_argument('--threshold', help='relative slow down reported as a regression, default is 0.1',
+                            type=float, default=0.1)
+
+parser_check = subparsers.add_parser('check', help='compare the vectorized learners to the serial ones')
+parser_check.add_argument('--worlds', help='worlds files, default is worlds/test, world1 and world2',
+                          nargs='*')
+parser_check.add_argument('--envs', help='number of envs of the vectorized learners, default is 100',
+                          type=positive_int, default=100)
+parser_check.add_argument('--games', help='number of games of each learner, default is 2000',
+                          type=int, default=2000)
+parser_check.add_argument('--alpha', help='learning rate, default is 0.05',
+                          type=float, default=0.05)
+parser_check.add_argument('--gamma', help='discount factor, default is 0.9',
+                          type=float, default=0.9)
+parser_check.add_argument('--seed', help='seed of the random generators, default is 0',
+                          type=int, default=0)
+parser_check.add_argument('--tolerance', help='maximum relative error, default is 0.5',
+                          type=float, default=0.5)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    elif args.command == 'check':
+        sys.exit(check(args))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,138 @@
+'''
+Save and restore the state of the learners in .npz files
+
+A checkpoint holds the tables of a learner (Q, N, vs...), the number of episodes done
+and the state of the random generators (random and numpy.random), so a run restarted
+from a checkpoint goes on as if it was never stopped
+Files are written atomically (temporary file, then renamed), by a background thread
+'''
+
+import numpy as np
+import os
+import random
+import threading
+
+
+'''
+Write arrays in the .npz file path atomically: readers see the old file or the new one,
+never a partially written file
+'''
+def save_npz(path, **arrays):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+'''
+Return the arrays of a .npz file as a dict
+'''
+def load_npz(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+'''
+State of the random generators, as arrays
+'''
+def rng_state():
+    version, keys, gauss = random.getstate()
+    name, np_keys, pos, has_gauss, cached = np.random.get_state()
+    return {
+        'rng_version': np.array(version),
+        'rng_keys': np.array(keys, dtype=np.uint64),
+        'rng_gauss': np.array(np.nan if gauss is None else gauss),
+        'np_rng_keys': np_keys,
+        'np_rng_pos': np.array(pos),
+        'np_rng_has_gauss': np.array(has_gauss),
+        'np_rng_cached': np.array(cached),
+    }
+
+def set_rng_state(state):
+    gauss = float(state['rng_gauss'])
+    random.setstate((int(state['rng_version']),
+                     tuple(int(k) for k in state['rng_keys']),
+                     None if np.isnan(gauss) else gauss))
+    np.random.set_state(('MT19937', state['np_rng_keys'], int(state['np_rng_pos']),
+                         int(state['np_rng_has_gauss']), float(state['np_rng_cached'])))
+
+
+'''
+Periodic checkpoints of a learner
+path: .npz file
+every: save the state every `every` episodes
+resume: restore the state saved in path (if it exists) when the learner starts
+
+Learners call restore(**tables) before the first episode, to get the first episode to play,
+and step(k, **tables) after each episode k
+Tables are numpy arrays, or objects with get_arrays() and set_arrays(arrays) (qtable.HashedQTable),
+saved as the arrays name_key
+step only copies the tables, the file is written by a background thread
+If the thread is still writing when a new checkpoint is ready, only the last one is kept
+'''
+class Checkpointer:
+
+    def __init__(self, path, every = 1000, resume = False):
+        self.path = path
+        self.every = every
+        self.resume = resume
+        self.pending = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    '''
+    Copy the saved tables into tables (in-place) and restore the random generators
+    Return the number of the first episode to play (1 if there is nothing to resume)
+    '''
+    def restore(self, **tables):
+        if not self.resume or not os.path.exists(self.path):
+            return 1
+
+        state = load_npz(self.path)
+        for key, table in tables.items():
+            if hasattr(table, 'set_arrays'):
+                prefix = key + '_'
+                table.set_arrays({name[len(prefix):]: array for name, array in state.items()
+                                  if name.startswith(prefix)})
+            else:
+                table[...] = state[key]
+        set_rng_state(state)
+        return int(state['episode']) + 1
+
+    def step(self, episode, **tables):
+        if episode % self.every != 0:
+            return
+
+        arrays = {}
+        for key, table in tables.items():
+            if hasattr(table, 'get_arrays'):
+                for name, array in table.get_arrays().items():
+                    arrays[key + '_' + name] = array
+            else:
+                arrays[key] = np.array(table)
+        arrays.update(rng_state())
+        arrays['episode'] = np.array(episode)
+        with self.cond:
+            self.pending = arrays
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                arrays = self.pending
+                self.pending = None
+            save_npz(self.path, **arrays)
+
+    '''
+    Wait until the last checkpoint is written
+    '''
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
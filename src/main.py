@@ -1,28 +1,60 @@
 import argparse
 import numpy as np
+import random
 import sys
+import zipfile
 
-import gaming
-import mdp2
-import monte_carlo
 from policy import Policy
-import td_learning
 import world
 
+#algorithm modules are only imported when needed, to keep startup fast
+
 
 #td learning sarsa_offline: world2
 
-def load_policy(world, data):
+def load_policy(world, data, gamma = 1.0):
 
     n = world.width * world.height
 
     if data == 'RAND':
         table = np.full((n, 4), 1. / 4.)
         return Policy(table)
+
+    #file saved with --save or --checkpoint: policy table, or greedy policy of Q or V
+    if data.endswith('.npz'):
+        import checkpoint
+        arrays = checkpoint.load_npz(data)
+        if 'policy' in arrays:
+            return Policy(arrays['policy'])
+        if 'Q' in arrays:
+            return Policy.build_deterministic(Policy.qvs_to_table(arrays['Q']))
+        if 'vs' not in arrays and 'N' in arrays and 'S' in arrays:
+            #Monte-Carlo policy evaluation checkpoint: V = S / N
+            import monte_carlo
+            arrays['vs'] = monte_carlo.values_from_statistics(arrays['N'], arrays['S'])
+        if 'vs' in arrays:
+            import mdp2
+            model = mdp2.MDP(world, gamma)
+            return model.qvs_to_policy(model.qvs_from_vs(arrays['vs']))
     
     return None
     
 
+'''
+Return the option that runs the learner of args in several processes (--workers)
+or on a vectorized world (--envs), None if it plays on a single World
+'''
+def batched_option(args):
+    if args.action == 'pistar' and args.full:
+        return None
+    if args.envs > 1 and (args.action, args.algorithm) in (('vpi', 'td0'), ('pistar', 'qlearn0')):
+        return '--envs'
+    if args.workers > 1 and (args.action, args.algorithm) in (
+            ('vpi', 'fvmc'), ('vpi', 'evmc'), ('vpi', 'evmcm'), ('vpi', 'td0'),
+            ('pistar', 'sarsa0'), ('pistar', 'qlearn0')):
+        return '--workers'
+    return None
+
 def default_policy(world):
     n = world.width * world.height
     table = np.random.rand(n, 4)
@@ -42,120 +74,351 @@ parser.add_argument('--lbda', help='lambda parameter for TD(lambda), in [0-1], d
                     type=float, nargs='?', default=0.5)
 parser.add_argument('--simus', help='number of times to play games, default is 10000',
                     type=int, nargs='?', default=10000)
-args = parser.parse_args()
-
-mode = args.action
-algo = args.algorithm
-alpha = args.alpha
-gamma = args.gamma
-lbda = args.lbda
-nsimus = args.simus
-w = world.World(args.world)
-w.gui_enabled = args.gui
-pi = load_policy(w, args.pi) if args.pi else default_policy(w)
-
-if mode == 'vpi':
-
-    if algo == 'system':
-        model = mdp2.MDP(w, gamma)
-        vs = model.policy_value_system(pi)
-        print(vs)
-
-    elif algo == 'ipe':
-        model = mdp2.MDP(w, gamma)
-        vs = model.iterative_policy_evaluation(pi, 50)
-        print(vs)
-
-    elif algo == 'fvmc':
-        vs = monte_carlo.policy_evaluation_first_visit(w, pi, nsimus, gamma)
-        print(vs)
-
-    elif algo == 'evmc':
-        vs = monte_carlo.policy_evaluation_every_visit(w, pi, nsimus, gamma)
+parser.add_argument('--iters', help='maximum number of iterations for iterative algorithms, default is 1000',
+                    type=int, nargs='?', default=1000)
+parser.add_argument('--replacing', help='use replacing eligibility traces instead of accumulating ones (bsarsal)',
+                    action='store_true')
+parser.add_argument('--envs', help='number of games played at the same time (vectorized td0 and qlearn0), default is 1',
+                    type=int, nargs='?', default=1)
+parser.add_argument('--workers', help='number of processes for Monte-Carlo and TD learning, default is 1',
+                    type=int, nargs='?', default=1)
+parser.add_argument('--seed', help='seed of the random generators',
+                    type=int, nargs='?', default=None)
+parser.add_argument('--full', help='learn over full game states (items, ghosts, magic pill) instead of player positions (gliemc, sarsa0, qlearn0)',
+                    action='store_true')
+parser.add_argument('--games', help='number of games played to score the policy found (pistar), default is 0 (no scoring)',
+                    type=int, nargs='?', default=0)
+parser.add_argument('--ci', help='stop scoring when the 95%% confidence interval of the mean score is smaller than this width',
+                    type=float, nargs='?', default=None)
+parser.add_argument('--metrics', help='write the metrics of each episode of Monte-Carlo and TD learning to this file (.jsonl or .csv)')
+parser.add_argument('--metrics-every', help='write the metrics every N episodes, default is 1',
+                    type=int, nargs='?', default=1)
+parser.add_argument('--metrics-steps', help='also write the metrics every N steps (td0, sarsa0, bsarsal, qlearn0), default is 0 (never)',
+                    type=int, nargs='?', default=0)
+parser.add_argument('--save', help='save the policy (pistar) or the values (vpi, vstar) found to this .npz file')
+parser.add_argument('--checkpoint', help='save the state of Monte-Carlo and TD learning to this .npz file during the run')
+parser.add_argument('--checkpoint-every', help='save a checkpoint every N episodes, default is 1000',
+                    type=int, nargs='?', default=1000)
+parser.add_argument('--resume', help='restart from the state saved in the --checkpoint file', action='store_true')
+parser.add_argument('--tol', help='stop iterative algorithms when the residual is below tol, default is 1e-6',
+                    type=float, nargs='?', default=1e-6)
+parser.add_argument('--outofcore', help='keep the model and the values in memory-mapped files in this directory (vpi ipe, vstar valiter), for maps bigger than the memory')
+parser.add_argument('--block', help='number of states swept at once with --outofcore, default is 65536',
+                    type=int, nargs='?', default=65536)
+
+
+'''
+Parse the arguments and run the action
+Kept out of the module level, so processes started with spawn can import this file
+'''
+def main():
+
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    if args.checkpoint and batched_option(args):
+        parser.error('--checkpoint is not supported with {}'.format(batched_option(args)))
+    if args.metrics and batched_option(args):
+        parser.error('--metrics is not supported with {}'.format(batched_option(args)))
+    if args.metrics_steps > 0:
+        if not args.metrics:
+            parser.error('--metrics-steps requires --metrics')
+        if args.full or (args.action, args.algorithm) not in (
+                ('vpi', 'td0'), ('pistar', 'sarsa0'), ('pistar', 'bsarsal'), ('pistar', 'qlearn0')):
+            parser.error('--metrics-steps is only supported by td0, sarsa0, bsarsal and qlearn0')
+
+    mode = args.action
+    algo = args.algorithm
+    alpha = args.alpha
+    gamma = args.gamma
+    lbda = args.lbda
+    nsimus = args.simus
+    iters = args.iters
+    tol = args.tol
+    nenvs = args.envs
+    workers = args.workers
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    #out-of-core mode: the world file is streamed to the model files, no World is built
+    if args.outofcore:
+        import mdp2
+        model = mdp2.OutOfCoreMDP(args.world, gamma, args.outofcore, args.block)
+        if mode == 'vpi' and algo == 'ipe':
+            if args.pi is None or args.pi == 'RAND':
+                table = np.broadcast_to(np.full(4, 1. / 4.), (model.n, 4))
+            elif args.pi.endswith('.npy') or args.pi.endswith('.npz'):
+                try:
+                    table = model.load_policy_table(args.pi)
+                except (OSError, ValueError) as e:
+                    sys.stderr.write('Invalid policy: {}\n'.format(e))
+                    sys.exit(1)
+            else:
+                sys.stderr.write("Invalid policy: '{}'\n".format(args.pi))
+                sys.exit(1)
+            vs, it, residual = model.iterative_policy_evaluation(Policy(table), iters, tol=tol)
+        elif mode == 'vstar' and algo == 'valiter':
+            vs, it, residual = model.value_iteration(iters, tol=tol)
+        else:
+            sys.stderr.write("Algorithm not available with --outofcore: '{} {}'\n".format(mode, algo))
+            sys.exit(1)
         print(vs)
-
-    elif algo == 'evmcm':
-        vs = monte_carlo.policy_evaluation_update(w, pi, alpha, nsimus, gamma)
-        print(vs)
-
-    elif algo == 'td0':
-        vs = td_learning.policy_evaluation_td0(w, pi, alpha, nsimus, gamma)
-        print(vs)
-
-    elif algo == 'ftdl':
-        sys.stderr.write('Not implemented\n')
+        print('iterations = {}, residual = {}'.format(it, residual))
+        print('values saved in {}'.format(vs.filename))
+        if args.save:
+            #np.savez writes the memory-mapped values by chunks, they are not loaded at once
+            import checkpoint
+            checkpoint.save_npz(args.save, vs=vs)
+        sys.exit(0)
+
+    w = world.World(args.world)
+    w.gui_enabled = args.gui
+    try:
+        pi = load_policy(w, args.pi, gamma) if args.pi else default_policy(w)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        sys.stderr.write('Invalid policy: {}\n'.format(e))
         sys.exit(1)
-
-    elif algo == 'btdl':
-        sys.stderr.write('Not implemented\n')
-        sys.exit(1)
-
-    elif algo == 'offtd0':
-        sys.stderr.write('Not implemented\n')
+    if pi is None:
+        sys.stderr.write("Invalid policy: '{}'\n".format(args.pi))
         sys.exit(1)
 
-    else:
-        sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
-        sys.exit(1)
+    callback = None
+    step_callback = None
+    if args.metrics:
+        import metrics
+        callback = metrics.MetricsWriter(args.metrics, args.metrics_every, args.metrics_steps)
+        if args.metrics_steps > 0:
+            step_callback = callback.step
+
+    ckpt = None
+    if args.checkpoint:
+        import checkpoint
+        ckpt = checkpoint.Checkpointer(args.checkpoint, args.checkpoint_every, args.resume)
+
+    if mode == 'vpi':
+
+        if algo == 'system':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            try:
+                vs = model.policy_value_system(pi)
+            except ValueError as e:
+                sys.stderr.write('{}\n'.format(e))
+                sys.exit(1)
+            print(vs)
+
+        elif algo == 'ipe':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            vs, it, residual = model.iterative_policy_evaluation(pi, iters, tol=tol)
+            print(vs)
+            print('iterations = {}, residual = {}'.format(it, residual))
+
+        elif algo == 'fvmc':
+            if workers > 1:
+                import parallel
+                vs = parallel.policy_evaluation_mc(args.world, pi, nsimus, gamma, workers,
+                                                   True, args.seed)
+            else:
+                import monte_carlo
+                vs = monte_carlo.policy_evaluation_first_visit(w, pi, nsimus, gamma, callback, ckpt)
+            print(vs)
+
+        elif algo == 'evmc':
+            if workers > 1:
+                import parallel
+                vs = parallel.policy_evaluation_mc(args.world, pi, nsimus, gamma, workers,
+                                                   False, args.seed)
+            else:
+                import monte_carlo
+                vs = monte_carlo.policy_evaluation_every_visit(w, pi, nsimus, gamma, callback, ckpt)
+            print(vs)
+
+        elif algo == 'evmcm':
+            if workers > 1:
+                import parallel
+                vs = parallel.policy_evaluation_update(args.world, w.width * w.height, pi, alpha,
+                                                       nsimus, gamma, workers, seed=args.seed)
+            else:
+                import monte_carlo
+                vs = monte_carlo.policy_evaluation_update(w, pi, alpha, nsimus, gamma,
+                                                        callback=callback, checkpoint=ckpt)
+            print(vs)
+
+        elif algo == 'td0':
+            if nenvs > 1:
+                import td_learning
+                import vec_world
+                vw = vec_world.VecWorld(args.world, nenvs, seed=args.seed)
+                vs = td_learning.policy_evaluation_td0_vec(vw, pi, alpha, nsimus, gamma)
+            elif workers > 1:
+                import parallel
+                vs = parallel.policy_evaluation_td0(args.world, w.width * w.height, pi, alpha,
+                                                    nsimus, gamma, workers, seed=args.seed)
+            else:
+                import td_learning
+                vs = td_learning.policy_evaluation_td0(w, pi, alpha, nsimus, gamma,
+                                                       callback=callback, checkpoint=ckpt,
+                                                       step_callback=step_callback)
+            print(vs)
+
+        elif algo == 'ftdl':
+            sys.stderr.write('Not implemented\n')
+            sys.exit(1)
+
+        elif algo == 'btdl':
+            sys.stderr.write('Not implemented\n')
+            sys.exit(1)
+
+        elif algo == 'offtd0':
+            sys.stderr.write('Not implemented\n')
+            sys.exit(1)
+
+        else:
+            sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
+            sys.exit(1)
+
+
+    elif mode == 'pistar':
+
+        #learned Q values over full game states (--full), scored instead of pi
+        Q = None
+
+        if algo == 'piiter':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            pi = model.policy_iteration(tol=tol)
+            print(pi.table)
+
+        elif algo == 'gliemc':
+            import monte_carlo
+            if args.full:
+                Q = monte_carlo.glie_control_full(w, nsimus, gamma, callback=callback,
+                                                  checkpoint=ckpt)
+                print('states = {}'.format(len(Q)))
+            else:
+                pi = monte_carlo.glie_control(w, nsimus, gamma, callback=callback, checkpoint=ckpt)
+                print(pi.table)
+
+        elif algo == 'sarsa0':
+            if args.full:
+                import td_learning
+                Q = td_learning.sarsa_full(w, alpha, nsimus, gamma, callback=callback,
+                                           checkpoint=ckpt)
+                print('states = {}'.format(len(Q)))
+            elif workers > 1:
+                import parallel
+                pi = parallel.sarsa(args.world, alpha, nsimus, gamma, workers, args.seed)
+                print(pi.table)
+            else:
+                import td_learning
+                pi = td_learning.sarsa(w, alpha, nsimus, gamma, callback=callback, checkpoint=ckpt,
+                                       step_callback=step_callback)
+                print(pi.table)
+
+        elif algo == 'fsarsal':
+            sys.stderr.write('Not implemented\n')
+            sys.exit(1)
+
+        elif algo == 'bsarsal':
+            import td_learning
+            pi = td_learning.sarsa_lambda(w, alpha, lbda, nsimus, gamma, args.replacing,
+                                          callback=callback, checkpoint=ckpt,
+                                          step_callback=step_callback)
+            print(pi.table)
+
+        elif algo == 'offtd0':
+            sys.stderr.write('Not implemented\n')
+            sys.exit(1)
+
+        elif algo == 'qlearn0':
+            if args.full:
+                import td_learning
+                Q = td_learning.sarsa_offline_full(w, alpha, nsimus, gamma, callback=callback,
+                                                   checkpoint=ckpt)
+                print('states = {}'.format(len(Q)))
+            elif nenvs > 1:
+                import td_learning
+                import vec_world
+                vw = vec_world.VecWorld(args.world, nenvs, seed=args.seed)
+                pi = td_learning.sarsa_offline_vec(vw, alpha, nsimus, gamma)
+                print(pi.table)
+            elif workers > 1:
+                import parallel
+                pi = parallel.sarsa_offline(args.world, alpha, nsimus, gamma, workers, args.seed)
+                print(pi.table)
+            else:
+                import td_learning
+                pi = td_learning.sarsa_offline(w, alpha, nsimus, gamma, callback=callback,
+                                               checkpoint=ckpt, step_callback=step_callback)
+                print(pi.table)
+        
+        else:
+            sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
+            sys.exit(1)
+
+        if args.games > 0:
+            import scoring
+            player = Q if Q is not None else pi
+            print(scoring.score_policy(args.world, player, args.games, workers, args.ci,
+                                       seed=args.seed))
+
+
+    elif mode == 'vstar':
+
+
+        if algo == 'valiter':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            vs, it, residual = model.value_iteration(iters, tol=tol)
+            print(vs)
+            print('iterations = {}, residual = {}'.format(it, residual))
+
+        elif algo == 'gsvaliter':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            vs, it, residual = model.value_iteration(iters, tol=tol, inplace=True)
+            print(vs)
+            print('iterations = {}, residual = {}'.format(it, residual))
+
+        elif algo == 'psweep':
+            import mdp2
+            model = mdp2.MDP(w, gamma)
+            vs, backups, residual = model.prioritized_sweeping(iters * w.width * w.height, tol=tol)
+            print(vs)
+            print('backups = {}, residual = {}'.format(backups, residual))
+        
+        else:
+            sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
+            sys.exit(1)
+
+
+    elif mode == 'qstar':
+        pass
 
 
-elif mode == 'pistar':
-
-
-    if algo == 'piiter':
-        model = mdp2.MDP(w, gamma)
-        pi = model.policy_iteration()
-        print(pi.table)
-
-    elif algo == 'gliemc':
-        pi = monte_carlo.glie_control(w, nsimus, gamma)
-        print(pi.table)
-
-    elif algo == 'sarsa0':
-        pi = td_learning.sarsa(w, alpha, nsimus, gamma)
-        print(pi.table)
-
-    elif algo == 'fsarsal':
-        sys.stderr.write('Not implemented\n')
-        sys.exit(1)
-
-    elif algo == 'bsarsal':
-        pi = td_learning.sarsa_lambda(w, alpha, lbda, nsimus, gamma)
-        print(pi.table)
-
-    elif algo == 'offtd0':
-        sys.stderr.write('Not implemented\n')
-        sys.exit(1)
-
-    elif algo == 'qlearn0':
-        pi = td_learning.sarsa_offline(w, alpha, nsimus, gamma)
-        print(pi.table)
-    
-    else:
-        sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
-        sys.exit(1)
-
-
-elif mode == 'vstar':
-
-
-    if algo == 'valiter':
-        model = mdp2.MDP(w, gamma)
-        vs = model.value_iteration(50)
-        print(vs)
-    
     else:
-        sys.stderr.write("Invalid algorithm: '{}'\n".format(algo))
+        sys.stderr.write("Invalid mode: '{}'\n".format(mode))
         sys.exit(1)
 
+    if callback is not None:
+        callback.close()
+    if ckpt is not None:
+        ckpt.close()
 
-elif mode == 'qstar':
-    pass
+    if args.save:
+        import checkpoint
+        if mode == 'pistar' and Q is None:
+            checkpoint.save_npz(args.save, policy=np.asarray(pi.table))
+        elif mode in ('vpi', 'vstar'):
+            checkpoint.save_npz(args.save, vs=np.asarray(vs))
+        else:
+            sys.stderr.write('Nothing to save\n')
 
 
-else:
-    sys.stderr.write("Invalid mode: '{}'\n".format(mode))
-    sys.exit(1)
+if __name__ == '__main__':
+    main()
 
 
 #model = mdp2.MDP(w)
@@ -2,7 +2,9 @@
 MDP with cs_xxx
 '''
 
-from utils import clamp, argmax
+import numpy as np
+from utils import argmax
+import weakref
 import world
 
 '''
@@ -24,32 +26,10 @@ GAMMA = 1
 
 '''
 Return the state you end up when doing a deterministic move from a state
+Read from the move table of the world, computed when it is loaded
 '''
 def get_next_cell(w, state, action):
-
-    sx = int(state % w.width)
-    sy = int(state / w.width)
-
-    oldx = sx
-    oldy = sy
-    
-    if action == world.ACTION_DOWN:
-        sy += 1
-    elif action == world.ACTION_LEFT:
-        sx -= 1
-    elif action == world.ACTION_RIGHT:
-        sx += 1
-    elif action == world.ACTION_UP:
-        sy -= 1
-
-    sx = clamp(sx, 0, w.width - 1)
-    sy = clamp(sy, 0, w.height - 1)
-
-    if w.get_cell(sx, sy).type == world.CELL_WALL:
-        sx = oldx
-        sy = oldy
-
-    return sy * w.width + sx
+    return w.moves[int(state)][action]
 
 '''
 Compute all the states you can end up and the probabilities for each when taking action in state
@@ -79,44 +59,81 @@ def get_next_states(w, state, action):
     
 
 '''
-Compute the value of a particular state using value iteration
-
-v_k+1 (s) = max_(a) sum(s') (T(s, a, s') * (R(s, a, s') + gamma * v_k(s')))
+Transition kernel of a world, computed only once for each world
+next[s, a, k]: k-th state you can end up when taking action a in state s
+probs[s, a, k]: probability to end up in next[s, a, k]
+rewards[s, a, k]: reward you get when you end up in next[s, a, k]
+terminal[s]: True for goal, wall and hole states (their value is always 0)
+Unused slots point to s with probability 0
 '''
-def get_state_value(w, vs, state):
+class Kernel:
 
-    cell = w.get_cell1(state)
+    def __init__(self, w):
 
-    if cell.type == world.CELL_GOAL:
-        return 0
-    
-    if cell.type == world.CELL_WALL:
-        return 0
+        n = w.width * w.height
+        self.next = np.zeros((n, 4, 4), dtype=np.int64)
+        self.probs = np.zeros((n, 4, 4))
+        self.rewards = np.zeros((n, 4, 4))
+        self.terminal = np.zeros(n, dtype=bool)
 
-    if cell.type == world.CELL_HOLE:
-        return 0
+        for s in range(0, n):
+            cell = w.get_cell1(s)
+            self.terminal[s] = cell.type in (world.CELL_GOAL, world.CELL_WALL, world.CELL_HOLE)
+            if self.terminal[s]:
+                self.next[s] = s
+                continue
 
-    max_val = -1000000
+            for action in range(0, 4):
+                self.next[s][action] = s
+                next, probs = get_next_states(w, s, action)
+                for k, (s2, p) in enumerate(zip(next, probs)):
+                    self.next[s][action][k] = s2
+                    self.probs[s][action][k] = p
+                    self.rewards[s][action][k] = world.CELL_REWARDS[w.get_cell1(s2).type]
 
-    for action in range(0, 4):
+    '''
+    Compute the q-values of all states (0 for terminal states)
+    q(s, a) = sum(s') (T(s, a, s') * (R(s, a, s') + gamma * v(s')))
+    '''
+    def qvalues(self, vs):
+        vs = np.asarray(vs, dtype=np.float64)
+        qvs = np.sum(self.probs * (self.rewards + GAMMA * vs[self.next]), axis=2)
+        qvs[self.terminal] = 0
+        return qvs
 
-        next, probs = get_next_states(w, state, action)
-        val = 0
-        for s2, p in zip(next, probs):
-            val += p * (world.CELL_REWARDS[w.get_cell1(s2).type] + GAMMA * vs[s2])
-        max_val = max(max_val, val)
 
-    return max_val
+_kernels = weakref.WeakKeyDictionary()
+
+'''
+Return the transition kernel of a world, computed at the first call only
+'''
+def get_kernel(w):
+    if w not in _kernels:
+        _kernels[w] = Kernel(w)
+    return _kernels[w]
+
+
+'''
+Compute the value of a particular state using value iteration
+
+v_k+1 (s) = max_(a) sum(s') (T(s, a, s') * (R(s, a, s') + gamma * v_k(s')))
+'''
+def get_state_value(w, vs, state):
+
+    kernel = get_kernel(w)
+    if kernel.terminal[state]:
+        return 0
+
+    next = kernel.next[state]
+    vals = np.sum(kernel.probs[state] * (kernel.rewards[state] + GAMMA * np.asarray(vs)[next]), axis=1)
+    return np.max(vals)
 
 
 '''
 Compute one iteration of the value iteration algorithm
 '''
 def value_iter_rec(w, vs):
-    next_vs = [0] * w.width * w.height
-    for s in range(0, w.width * w.height):
-        next_vs[s] = get_state_value(w, vs, s)
-    return next_vs
+    return np.max(get_kernel(w).qvalues(vs), axis=1).tolist()
 
 '''
 Compute k iterations of the value iteration algorithm
@@ -136,33 +153,23 @@ v_k+1 (s) = max_(a) sum(s') (T(s, a, s') * (R(s, a, s') + gamma * v_k(s')))
 '''
 def get_policy_state_value(w, vs, state, policy):
 
-    cell = w.get_cell1(state)
-
-    if cell.type == world.CELL_GOAL:
-        return 0
-    
-    if cell.type == world.CELL_WALL:
-        return 0
-
-    if cell.type == world.CELL_HOLE:
+    kernel = get_kernel(w)
+    if kernel.terminal[state]:
         return 0
 
     action = policy[state]
-    next, probs = get_next_states(w, state, action)
-    val = 0
-    for s2, p in zip(next, probs):
-        val += p * (world.CELL_REWARDS[w.get_cell1(s2).type] + GAMMA * vs[s2])
-
-    return val
+    next = kernel.next[state][action]
+    probs = kernel.probs[state][action]
+    rewards = kernel.rewards[state][action]
+    return np.sum(probs * (rewards + GAMMA * np.asarray(vs)[next]))
 
 '''
 Compute one iteration of the value iteration algorithm with fixed policy
 '''
 def policy_value_iter_rec(w, vs, policy):
-    next_vs = [0] * w.width * w.height
-    for s in range(0, w.width * w.height):
-        next_vs[s] = get_policy_state_value(w, vs, s, policy)
-    return next_vs
+    actions = [0 if a == None else a for a in policy]
+    qvs = get_kernel(w).qvalues(vs)
+    return qvs[np.arange(len(actions)), actions].tolist()
 
 '''
 Compute k iterations of the value iteration algorithm with fixed policy
@@ -181,31 +188,13 @@ pi* (s) = arg_max_(a) sum(s') (T(s, a, s') * (R(s, a, s') + gamma * v_k(s')))
 '''
 def get_state_action(w, vs, state):
 
-    cell = w.get_cell1(state)
-
-    if cell.type == world.CELL_GOAL:
-        return None
-    
-    if cell.type == world.CELL_WALL:
-        return None
-
-    if cell.type == world.CELL_HOLE:
+    kernel = get_kernel(w)
+    if kernel.terminal[state]:
         return None
 
-    max_val = -1000000
-    max_action = None
-
-    for action in range(0, 4):
-
-        next, probs = get_next_states(w, state, action)
-        val = 0
-        for s2, p in zip(next, probs):
-            val += p * (world.CELL_REWARDS[w.get_cell1(s2).type] + GAMMA * vs[s2])
-        if val > max_val:
-            max_val = val
-            max_action = action
-
-    return max_action
+    next = kernel.next[state]
+    vals = np.sum(kernel.probs[state] * (kernel.rewards[state] + GAMMA * np.asarray(vs)[next]), axis=1)
+    return int(np.argmax(vals))
 
 
 '''
@@ -214,11 +203,10 @@ Return array : [state] => action
 '''
 def policy_extraction(w, vs):
 
-    policy = [None] * w.width * w.height
-    
-    for s in range(0, w.width * w.height):
-        policy[s] = get_state_action(w, vs, s)
-
+    kernel = get_kernel(w)
+    policy = np.argmax(kernel.qvalues(vs), axis=1).tolist()
+    for s in np.flatnonzero(kernel.terminal):
+        policy[s] = None
     return policy
 
 '''
@@ -273,22 +261,15 @@ def play_game_policy(w, policy):
     return w.score
 
 '''
-Play multiple games with policy and print states
+Play multiple games with policy (array [state] => action)
+Terminal states and walls have no action (None), they are never played
+Return the statistics of the scores (scoring.ScoreStats)
 '''
-def play_games_policy(w, policy, nsimus):
-    sum_score = 0
-    min_score = float("inf")
-    max_score = - float("inf")
-
-    for _ in range(nsimus):
-       score = play_game_policy(w, policy)
-       sum_score += score
-       min_score =min(min_score, score)
-       max_score = max(max_score, score)
-
-    print("min = " + str(min_score))
-    print("av  = " + str(sum_score / nsimus))
-    print("max = " + str(max_score))
+def play_games_policy(w, policy, nsimus, ci_width = None, confidence = 0.95):
+    import scoring
+    from policy import Policy
+    player = Policy.build_deterministic([0 if a == None else a for a in policy])
+    return scoring.play_games(w, player, nsimus, ci_width, confidence)
     
 
 '''
@@ -297,14 +278,14 @@ Use policy extraction to find optimal policy then play it on several games
 def simu_policy_extraction(w, nsimus):
     vs = value_iter(w, 20)
     policy = policy_extraction(w, vs)
-    play_games_policy(w, policy, nsimus)
+    print(play_games_policy(w, policy, nsimus))
     
 '''
 Use policy iteration to find optimal policy then play it on several games
 '''
 def simu_policy_iteration(w, nsimus):
     policy = policy_iteration(w)
-    play_games_policy(w, policy, nsimus)
+    print(play_games_policy(w, policy, nsimus))
 
 
 
@@ -316,24 +297,14 @@ q_k+1 (s, a) = sum(s') T(s, a, s') (R(s, a, s') + gamma * max(a') q_k(s', a'))
 '''
 def get_state_action_qvalue(w, qvs, state, action):
 
-    cell = w.get_cell1(state)
-
-    if cell.type == world.CELL_GOAL:
-        return 0
-    
-    if cell.type == world.CELL_WALL:
-        return 0
-
-    if cell.type == world.CELL_HOLE:
+    kernel = get_kernel(w)
+    if kernel.terminal[state]:
         return 0
 
-    qval = 0
-    next, probs = get_next_states(w, state, action)
-
-    for s2, p in zip(next, probs):
-        qval += p * (world.CELL_REWARDS[w.get_cell1(s2).type] + GAMMA * max(qvs[s2]))
-
-    return qval
+    next = kernel.next[state][action]
+    probs = kernel.probs[state][action]
+    rewards = kernel.rewards[state][action]
+    return np.sum(probs * (rewards + GAMMA * np.max(np.asarray(qvs)[next], axis=1)))
 
 
 
@@ -341,11 +312,7 @@ def get_state_action_qvalue(w, qvs, state, action):
 Compute one iteration of the q-value iteration algorithm
 '''
 def qvalue_iter_rec(w, qvs):
-    next_qvs = [[0 for _ in range(4)] for _ in range(w.width * w.height)]
-    for s in range(0, w.width * w.height):
-        for a in range(0, 4):
-            next_qvs[s][a] = get_state_action_qvalue(w, qvs, s, a)
-    return next_qvs
+    return get_kernel(w).qvalues(np.max(qvs, axis=1)).tolist()
 
 '''
 Compute k iterations of the q-value iteration algorithm
@@ -362,4 +329,4 @@ Use qvalue iteration to find optimal policy then play it on several games
 def simu_qvalue_iter(w, nsimus):
     qvs = qvalue_iter(w, 20)
     policy = policy_extraction_q(w, qvs)
-    play_games_policy(w, policy, nsimus)
+    print(play_games_policy(w, policy, nsimus))
@@ -13,40 +13,23 @@ Items and enemies are ignored
 
 '''
 
+import heapq
 import numpy as np
+import os
 import random
+import zipfile
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as splinalg
 from policy import Policy
-from utils import clamp
 import world
 
 '''
 Return the state you end up when doing a deterministic move from a state
+Read from the move table of the world, computed when it is loaded
 '''
 def get_next_cell(w, state, action):
-
-    sx = int(state % w.width)
-    sy = int(state / w.width)
-
-    oldx = sx
-    oldy = sy
-    
-    if action == world.ACTION_DOWN:
-        sy += 1
-    elif action == world.ACTION_LEFT:
-        sx -= 1
-    elif action == world.ACTION_RIGHT:
-        sx += 1
-    elif action == world.ACTION_UP:
-        sy -= 1
-
-    sx = clamp(sx, 0, w.width - 1)
-    sy = clamp(sy, 0, w.height - 1)
-
-    if w.get_cell(sx, sy).type == world.CELL_WALL:
-        sx = oldx
-        sy = oldy
-
-    return sy * w.width + sx
+    return w.moves[int(state)][action]
 
 '''
 Compute all the states you can end up and the probabilities for each when taking action in state
@@ -86,6 +69,37 @@ def get_state_reward(w, s):
         val = 0
     return val   
 
+'''
+Compute the cell types and move grid for all states at once
+types[s] = type of the cell of state s
+moves[s, a] = get_next_cell(w, s, a)
+'''
+def build_grid(w):
+    types = np.array([c.type for c in w.cells])
+    return types, w.moves_array
+
+'''
+Return the reward you get in each state
+'''
+def get_state_rewards(types):
+    rewards = np.array([0 if r == None else r for r in world.CELL_REWARDS], dtype=np.float64)
+    return rewards[types]
+
+'''
+Return the states that can reach one of the targets in the graph with edges src[i] -> dst[i]
+States are sorted by their distance (number of edges) to the closest target
+'''
+def reaching_states(n, src, dst, targets):
+
+    # reversed graph, with an extra node n linked to every target
+    rows = np.concatenate([dst, np.full(len(targets), n)])
+    cols = np.concatenate([src, targets])
+    graph = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n + 1, n + 1))
+
+    order = csgraph.breadth_first_order(graph, n, directed=True,
+                                        return_predecessors=False)
+    return order[1:]
+
 '''
 S: set of states (0 -> w.width * w.height - 1)
 A: set of actions (directions 0 -> 3)
@@ -104,21 +118,36 @@ class MDP:
 
 
     '''
-    Generate state transition probability matrix P
-    P(a, s, s') = p(S_t+1 = s' | S_t = s, A_t = a) 
+    Generate state transition probability matrix P, stored in sparse form
+    Each (s, a) has at most 4 successors (one for each real move), so P is kept as
+    two arrays of shape (4, n, 4) instead of a dense (4, n, n) tensor
+    P_next(a, s, k) = state you end up when the real move is k
+    P_probs(a, s, k) = probability that the real move is k when taking action a
+    Terminal states and walls have probability 0 for every slot
+    The successors don't depend on a: only moves(s, k) = P_next(a, s, k) is stored,
+    P_next is a read-only broadcast view of it
+
+    P(a, s, s') = sum(k, P_next(a, s, k) = s') P_probs(a, s, k)
     '''
     def build_p(self):
         w = self.world
-        P = np.zeros((4, w.width * w.height, w.width * w.height))
+        n = w.width * w.height
+        self.types, moves = build_grid(w)
 
-        for s1 in range(w.width * w.height):
-            for a in range(4):
-                next, probs = get_next_states(w, s1, a)
-                for s2, proba in zip(next, probs):
-                    P[a][s1][s2] = proba
-                
+        active = ((self.types != world.CELL_WALL) & (self.types != world.CELL_GOAL)
+                  & (self.types != world.CELL_HOLE))
+        slip = np.full((4, 4), (1 - w.proba_action_valid) / 4) + np.eye(4) * w.proba_action_valid
+
+        self.moves = moves
+        self.P_next = np.broadcast_to(moves, (4, n, 4))
+        self.P_probs = slip[:, None, :] * active[None, :, None]
 
-        self.P = P
+    '''
+    Compute P(a) * v for every action
+    res(a, s) = sum(s' in S) P(a, s, s') v(s')
+    '''
+    def p_dot(self, vs):
+        return np.sum(self.P_probs * vs[self.moves][None, :, :], axis=2)
 
     '''
     Generate reward matrix R
@@ -126,130 +155,136 @@ class MDP:
     R(a, s) = sum_(s' in S) P(a, s, s') * R_t
     '''
     def build_r(self):
-        w = self.world
-
-        R = np.zeros((4, w.width * w.height))
-
-        rewards = [0] * w.width * w.height
-        for s in range(w.width * w.height):
-            rewards[s] = get_state_reward(w, s)
-
-        for a in range(4):
-            for s1 in range(w.width * w.height):
-                val = 0
-                for s2 in range(w.width * w.height):
-                    val += self.P[a][s1][s2] * rewards[s2]
-                R[a][s1] = val
-
-        self.R = R
+        self.R = self.p_dot(get_state_rewards(self.types))
 
 
     '''
-    Return P matrx following policy
+    Return P matrix following policy, in the same sparse form than P
+    (with 16 slots: one for each action and real move)
     P_pi(s, s') = sum(a in A) pi(a|s) * P(a, s, s')
     '''
     def p_policy(self, policy):
 
-        w = self.world
-        P_pi = np.zeros((w.width * w.height, w.width * w.height))
-
-        for s1 in range(w.width * w.height):
-            for s2 in range(w.width * w.height):
-                val = 0
-                for a in range(4):
-                    val += policy.table[s1][a] * self.P[a][s1][s2]
-                P_pi[s1][s2] = val
-
-        return P_pi
+        n = self.P_next.shape[1]
+        table = np.asarray(policy.table)
+        P_next = np.tile(self.moves, (1, 4))
+        P_probs = (table.T[:, :, None] * self.P_probs).transpose(1, 0, 2).reshape(n, 16)
+        return P_next, P_probs
 
     '''
     Return R table following policy
     R_pi(s) = sum(a in A) pi(a|s) * R(a, s)
     '''
     def r_policy(self, policy):
+        return np.sum(np.asarray(policy.table) * self.R.T, axis=1)
 
-        w = self.world
-        R_pi = np.zeros((w.width * w.height))
-        for s in range(w.width * w.height):
-            val = 0
-            for a in range(4):
-                val += policy.table[s][a] * self.R[a][s]
-            R_pi[s] = val
+    '''
+    Return P matrix following policy as a scipy sparse (n, n) matrix
+    '''
+    def p_policy_matrix(self, policy):
+        n = self.P_next.shape[1]
+        P_next, P_probs = self.p_policy(policy)
+        rows = np.repeat(np.arange(n), P_next.shape[1])
+        P_pi = sparse.csr_matrix((P_probs.ravel(), (rows, P_next.ravel())), shape=(n, n))
+        P_pi.eliminate_zeros()
+        return P_pi
+
+    '''
+    Return the states from which following policy can never reach a terminal state
+    (or a wall), ie the game never ends
+    With GAMMA = 1, I - GAMMA * P_pi is singular iff there is at least one such state
+    '''
+    def non_absorbing_states(self, policy):
+        n = self.P_next.shape[1]
+        P_pi = self.p_policy_matrix(policy).tocoo()
+        terminals = np.flatnonzero(self.P_probs.sum(axis=(0, 2)) == 0)
 
-        return R_pi
+        absorbing = np.zeros(n, dtype=bool)
+        absorbing[reaching_states(n, P_pi.row, P_pi.col, terminals)] = True
+        return np.flatnonzero(~absorbing)
+
+    '''
+    Return all non terminal states, sorted by their distance to a goal cell
+    States that can't reach a goal cell are at the end
+    Good ordering for in-place value iteration: values are propagated from the goal
+    '''
+    def goal_distance_order(self):
+        n = self.P_next.shape[1]
+        active = self.P_probs.sum(axis=(0, 2)) > 0
+        src = np.repeat(np.flatnonzero(active), 4)
+        dst = self.moves[active].ravel()
+        goals = np.flatnonzero(self.types == world.CELL_GOAL)
+
+        order = reaching_states(n, src, dst, goals)
+        order = order[active[order]]
+        others = np.setdiff1d(np.flatnonzero(active), order)
+        return np.concatenate([order, others])
 
     ''' 
     Compute v_pi(s) solving a system of equations
     v_pi = (I - GAMMA * P_pi)^-1 * R_pi
+    The system is solved with a sparse LU factorization, without computing the inverse
+    Raise ValueError if the system is singular (GAMMA = 1 and the game may never end)
     '''
     def policy_value_system(self, policy):
         w = self.world
         n = w.width * w.height
-        m1 = np.eye(n) - self.gamma * self.p_policy(policy)
-        return np.dot(np.linalg.inv(m1), self.r_policy(policy))
+
+        if self.gamma >= 1:
+            loops = self.non_absorbing_states(policy)
+            if len(loops) > 0:
+                raise ValueError('policy never reaches a terminal state from {} states (first: {}), '
+                                 'system is singular with gamma = {}'
+                                 .format(len(loops), loops[0], self.gamma))
+
+        m1 = sparse.identity(n, format='csc') - self.gamma * self.p_policy_matrix(policy).tocsc()
+        return splinalg.spsolve(m1, self.r_policy(policy))
 
     '''
-    Apply k steps of iterative policy evaluation
+    Apply at most k steps of iterative policy evaluation
     Start with default value of 0 for each state, or another value
+    Stop as soon as the Bellman residual max(s) |v_k+1(s) - v_k(s)| <= tol
 
     v_k+1(s) = sum(a in A) pi(a|s) * (R(a, s) + GAMMA * sum(s' in S) P(a, s, s') v_k(s')) 
     v_k+1 = R_pi + GAMMA * P_pi * v_k
     Both computations are equals, second is just the matrix form
-    First one is implemented
+    Second one is implemented, with P_pi in sparse form
+
+    Return (v, number of iterations done, final residual)
     '''
-    def iterative_policy_evaluation(self, policy, k, vs = None):
+    def iterative_policy_evaluation(self, policy, k, vs = None, tol = 0):
 
         w = self.world
         n = w.width * w.height
-        if vs == None:
+        if vs is None:
             vs = np.zeros((n))
-            
-        for _ in range(k):
-            new_vs = np.zeros((n))
-            for s in range(n):
-                val = 0
-                for a in range(4):
-                    val2 = 0
-                    for s2 in range(n):
-                        val2 += self.P[a][s][s2] * vs[s2]
-                    val += policy.table[s][a] * (self.R[a][s] + self.gamma * val2)
-                new_vs[s] = val
+
+        P_next, P_probs = self.p_policy(policy)
+        R_pi = self.r_policy(policy)
+
+        it = 0
+        residual = float('inf')
+        while it < k and residual > tol:
+            new_vs = R_pi + self.gamma * np.sum(P_probs * vs[P_next], axis=1)
+            residual = np.max(np.abs(new_vs - vs))
             vs = new_vs
+            it += 1
 
-        return vs
+        return vs, it, residual
 
     '''
     Compute optimal policy from q-values
     pi(a|s) = (a == argmax(a) q(s, a) 
     '''
     def qvs_to_policy(self, qvs):
-
-        w = self.world
-        n = w.width * w.height
-        policy = [0] * n
-
-        for s in range(n):
-            policy[s] = np.argmax(qvs[s])
-
-        return Policy.build_deterministic(policy)
+        return Policy.build_deterministic(np.argmax(qvs, axis=1))
 
     ''''
     Compute q-values from values
     q(s, a) = R(a, s) + GAMMA * sum(s' in S) P(a, s, s') v(s')
     '''
     def qvs_from_vs(self, vs):
-        w = self.world
-        n = w.width * w.height
-        qvs = np.zeros((n, 4))
-
-        for s in range(n):
-            for a in range(4):
-                val = 0
-                for s2 in range(n):
-                    val += self.P[a, s, s2] * vs[s2]
-                qvs[s][a] = self.R[a][s] + self.gamma * val
-
-        return qvs
+        return (self.R + self.gamma * self.p_dot(vs)).T
 
     
     '''
@@ -258,54 +293,399 @@ class MDP:
     2) choose new policy pi' that take optimal solutions from q-values
     3) if pi' is different from pi, go back to 1 with pi'
     4) policy converges, it's optimal, return it
+
+    Modified policy iteration: step 1 is only a partial evaluation
+    m: maximum number of sweeps of iterative policy evaluation
+    tol: stop the evaluation earlier when the residual is <= tol
+    warm_start: start each evaluation from the values of the previous one,
+    instead of 0
     '''
-    def policy_iteration(self, policy = None):
+    def policy_iteration(self, policy = None, m = 20, tol = 0, warm_start = True):
 
         w = self.world
 
-        if policy == None:
+        if policy is None:
             policy = Policy.build_deterministic([0] * w.width * w.height)
 
+        vs = None
+        actions = np.argmax(policy.table, axis=1)
         while True:
-            old_policy = policy
-            vs = self.iterative_policy_evaluation(policy, 20)
-            qvs = self.qvs_from_vs(vs)
-            policy = self.qvs_to_policy(qvs)
-            if policy == old_policy:
+            vs, _, _ = self.iterative_policy_evaluation(policy, m, vs if warm_start else None, tol)
+            old_actions = actions
+            actions = np.argmax(self.qvs_from_vs(vs), axis=1)
+            policy = Policy.build_deterministic(actions)
+            if np.array_equal(actions, old_actions):
                 break
 
         return policy
 
     '''
-    Apply k steps of value iteration
+    Apply at most k steps of value iteration
     Convert to v*
     By default, start with v_0(s) = 0
     
     V_k+1(s) = max(a in A) (R(a, s) + GAMMA * sum(s' in S) P(a, s, s') * V_k(s'))
     V_k+1 = max(a in A) (R(a) + GAMMA * P(a) * V_k)
     Both computations are equal, but second one is matrix form
+
+    inplace: if False, use matrix form (Jacobi)
+             if True, use Gauss-Seidel: each state is updated in-place,
+             following order (array of states, by default goal_distance_order())
+    Stop as soon as the Bellman residual max(s) |V_k+1(s) - V_k(s)| <= tol,
+    or if stable_policy is True when the greedy policy didn't change during a sweep
+
+    Return (v, number of sweeps done, final residual)
     '''
-    def value_iteration(self, k, vs = None):
+    def value_iteration(self, k, vs = None, tol = 0, inplace = False, order = None,
+                        stable_policy = False):
         w = self.world
         n = w.width * w.height
-        if vs == None:
+        if vs is None:
             vs = np.zeros((n))
+        vs = np.array(vs, dtype=np.float64)
+
+        if inplace:
+            if order is None:
+                order = self.goal_distance_order()
+            order = list(order)
+            R = self.R.T.tolist()
+            moves = self.moves.tolist()
+            P_probs = self.P_probs.transpose(1, 0, 2).tolist()
+            gamma = self.gamma
+            vals = vs.tolist()
+
+        it = 0
+        residual = float('inf')
+        actions = None
+        while it < k:
+
+            if inplace:
+                residual = 0
+                for s in order:
+                    max_val = - float('inf')
+                    for a in range(4):
+                        val2 = 0
+                        for s2, p in zip(moves[s], P_probs[s][a]):
+                            val2 += p * vals[s2]
+                        max_val = max(max_val, R[s][a] + gamma * val2)
+                    residual = max(residual, abs(max_val - vals[s]))
+                    vals[s] = max_val
+                vs = np.array(vals)
+
+            else:
+                new_vs = np.max(self.R + self.gamma * self.p_dot(vs), axis=0)
+                residual = np.max(np.abs(new_vs - vs))
+                vs = new_vs
+            it += 1
+
+            if residual <= tol:
+                break
+            if stable_policy:
+                old_actions = actions
+                actions = np.argmax(self.R + self.gamma * self.p_dot(vs), axis=0)
+                if old_actions is not None and np.array_equal(actions, old_actions):
+                    break
 
-        for _ in range(k):
-            new_vs = np.zeros((n))
+        return vs, it, residual
 
-            for s in range(n):
-                max_val = 0
-                for a in range(4):
-                    val2 = 0
-                    for s2 in range(n):
-                        val2 += self.P[a][s][s2] * vs[s2]
 
-                    val = self.R[a][s] + self.gamma * val2
-                    max_val = max(max_val, val)
+    '''
+    Return predecessors of each state, as a CSR-like index
+    predecessors of s are preds[indptr[s]:indptr[s+1]]
+    s' is a predecessor of s if P(a, s', s) > 0 for some action a
+    '''
+    def predecessors(self):
+        n = self.P_next.shape[1]
+        mask = self.P_probs > 0
+        src = np.broadcast_to(np.arange(n)[None, :, None], mask.shape)[mask]
+        dst = self.P_next[mask]
+        graph = sparse.csr_matrix((np.ones(len(src)), (dst, src)), shape=(n, n))
+        return graph.indptr, graph.indices
 
-                new_vs[s] = max_val
-            
-            vs = new_vs
+    '''
+    Prioritized sweeping value iteration
+    Instead of backing up every state at each sweep, keep a priority queue of states
+    sorted by their Bellman error |max(a in A) (R(a, s) + GAMMA * P(a, s) * V) - V(s)|
+    1) back up the state with the biggest error
+    2) recompute the error of all its predecessors, and queue them if the error > tol
+    3) go back to 1 until the queue is empty, or max_backups backups are done
+
+    Return (v, number of backups done, final residual)
+    '''
+    def prioritized_sweeping(self, max_backups, vs = None, tol = 0):
+        w = self.world
+        n = w.width * w.height
+        if vs is None:
+            vs = np.zeros((n))
+        vs = np.array(vs, dtype=np.float64)
+
+        R = self.R.T.tolist()
+        moves = self.moves.tolist()
+        P_probs = self.P_probs.transpose(1, 0, 2).tolist()
+        gamma = self.gamma
+        indptr, preds = self.predecessors()
+        indptr = indptr.tolist()
+        preds = preds.tolist()
+
+        def backup(s):
+            max_val = - float('inf')
+            for a in range(4):
+                val2 = 0
+                for s2, p in zip(moves[s], P_probs[s][a]):
+                    val2 += p * vals[s2]
+                max_val = max(max_val, R[s][a] + gamma * val2)
+            return max_val
+
+        errors = np.abs(np.max(self.R + self.gamma * self.p_dot(vs), axis=0) - vs)
+        queue = [(-err, s) for s, err in enumerate(errors.tolist()) if err > tol]
+        heapq.heapify(queue)
+        priority = errors.tolist()
+        vals = vs.tolist()
+
+        backups = 0
+        while queue and backups < max_backups:
+            err, s = heapq.heappop(queue)
+            if -err != priority[s]:
+                continue
+
+            vals[s] = backup(s)
+            priority[s] = 0
+            backups += 1
+
+            for s2 in preds[indptr[s]:indptr[s + 1]]:
+                err = abs(backup(s2) - vals[s2])
+                if err > tol and err != priority[s2]:
+                    priority[s2] = err
+                    heapq.heappush(queue, (-err, s2))
+
+        vs = np.array(vals)
+        residual = np.max(np.abs(np.max(self.R + self.gamma * self.p_dot(vs), axis=0) - vs))
+        return vs, backups, residual
+
+
+#number of states of a block of the out-of-core sweeps
+#about 2 MB of model arrays per block, so a block stays in the CPU cache
+OUT_OF_CORE_BLOCK = 1 << 16
+
+#type of each map code, codes of items and agents are ground cells
+CODE_TYPES = {'G': world.CELL_GOAL, 'W': world.CELL_WALL, 'H': world.CELL_HOLE}
+
+
+'''
+Out-of-core MDP, for maps too big to keep the model and the values in memory
+The world file is read line by line (no World object), and every n-length array is a
+memory-mapped .npy file in directory:
+    types.npy: type of each cell
+    active.npy: False for terminal states and walls
+    moves.npy: moves(s, k) = state you end up from s when the real move is k
+    R.npy: R(s, a), same as MDP.R transposed
+    vs0.npy, vs1.npy: values of the current and next sweep
+P(a, s, s') is not stored: P(a, s, k) = slip(a, k) * active(s), and P_next(a, s, k) = moves(s, k)
+
+Sweeps go through the states by blocks of `block` states: the successors of a block are
+at most one row away, so the files are streamed from the disk
+'''
+class OutOfCoreMDP:
+
+    def __init__(self, path, gamma, directory, block = OUT_OF_CORE_BLOCK):
+        self.gamma = gamma
+        self.directory = directory
+        self.block = block
+        os.makedirs(directory, exist_ok=True)
+        self.read_world(path)
+        self.build_p()
+        self.build_r()
+        self.values = [self.array('vs0', (self.n,)), self.array('vs1', (self.n,))]
+
+    '''
+    Create the memory-mapped array directory/name.npy
+    '''
+    def array(self, name, shape, dtype = np.float64):
+        return np.lib.format.open_memmap(os.path.join(self.directory, name + '.npy'),
+                                         mode='w+', dtype=dtype, shape=shape)
+
+    '''
+    Ranges [i, j) of the blocks of states
+    '''
+    def blocks(self):
+        for i in range(0, self.n, self.block):
+            yield i, min(i + self.block, self.n)
+
+    '''
+    Read the map and the probability of a valid action from the world file
+    Same format as world.World, the map is written row by row in types
+    '''
+    def read_world(self, path):
+        codes = np.full(256, world.CELL_GROUND, dtype=np.int8)
+        for code, t in CODE_TYPES.items():
+            codes[ord(code)] = t
+
+        key = None
+        y = 0
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+
+                if '=' in line:
+                    pos = line.index('=')
+                    key = line[:pos].strip().upper()
+                    val = line[pos+1:].strip()
+                    if key == 'MAP':
+                        pos = val.index('*')
+                        self.width = int(val[:pos].strip())
+                        self.height = int(val[pos+1:].strip())
+                        self.n = self.width * self.height
+                        self.types = self.array('types', (self.n,), np.int8)
+                    elif key == 'PROBA_ACTION_VALID':
+                        self.proba_action_valid = float(val)
+                elif key == 'MAP' and y < self.height:
+                    row = np.frombuffer(line[:self.width].encode('ascii'), dtype=np.uint8)
+                    self.types[y * self.width:(y + 1) * self.width] = codes[row]
+                    y += 1
+
+    '''
+    Build moves and active block by block, as world.World.build_moves
+    '''
+    def build_p(self):
+        p = self.proba_action_valid
+        self.slip = np.full((4, 4), (1 - p) / 4) + np.eye(4) * p
+        dtype = np.int32 if self.n < 2 ** 31 else np.int64
+        self.moves = self.array('moves', (self.n, 4), dtype)
+        self.active = self.array('active', (self.n,), bool)
+
+        for i, j in self.blocks():
+            states = np.arange(i, j)
+            xs = states % self.width
+            ys = states // self.width
+            for a in range(4):
+                sx = np.clip(xs + world.ACTION_DX[a], 0, self.width - 1)
+                sy = np.clip(ys + world.ACTION_DY[a], 0, self.height - 1)
+                s2 = sy * self.width + sx
+                self.moves[i:j, a] = np.where(self.types[s2] == world.CELL_WALL, states, s2)
+            types = self.types[i:j]
+            self.active[i:j] = ((types != world.CELL_WALL) & (types != world.CELL_GOAL)
+                                & (types != world.CELL_HOLE))
+
+    '''
+    Compute P(a) * v for the states of the block [i, j)
+    res(s, a) = active(s) * sum(k) slip(a, k) * v(moves(s, k))
+    '''
+    def p_dot(self, vs, i, j):
+        return self.active[i:j, None] * np.dot(vs[self.moves[i:j]], self.slip.T)
+
+    '''
+    Generate reward matrix R, block by block
+    R(s, a) = sum_(s' in S) P(a, s, s') * R_t
+    '''
+    def build_r(self):
+        self.R = self.array('R', (self.n, 4))
+        for i, j in self.blocks():
+            rewards = get_state_rewards(self.types[self.moves[i:j]])
+            self.R[i:j] = self.active[i:j, None] * np.dot(rewards, self.slip.T)
+
+    '''
+    Return a policy table (n, 4) that is not loaded in memory
+    path: .npy file, memory-mapped, or .npz file saved with --save, its 'policy' array is
+    copied block by block to directory/policy.npy
+    Raise ValueError if the file has no policy table of the right shape
+    '''
+    def load_policy_table(self, path):
+        if path.endswith('.npy'):
+            table = np.load(path, mmap_mode='r')
+        else:
+            with zipfile.ZipFile(path) as archive:
+                if 'policy.npy' not in archive.namelist():
+                    raise ValueError('no policy in {}'.format(path))
+                with archive.open('policy.npy') as f:
+                    table = self.read_npy_blocks(f)
+
+        if table.shape != (self.n, 4):
+            raise ValueError('policy of shape {} in {}, expected {}'
+                             .format(table.shape, path, (self.n, 4)))
+        return table
+
+    '''
+    Copy a .npy array from the file object f to directory/policy.npy, block by block
+    '''
+    def read_npy_blocks(self, f):
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order or len(shape) != 2 or shape[0] != self.n:
+            raise ValueError('policy of shape {} expected {}'.format(shape, (self.n, 4)))
+
+        table = self.array('policy', shape)
+        row = shape[1] * dtype.itemsize
+        for i, j in self.blocks():
+            table[i:j] = np.frombuffer(f.read((j - i) * row), dtype=dtype).reshape(j - i, shape[1])
+        table.flush()
+        return table
+
+    '''
+    Copy vs (or 0) into the values file used as v_0 by the solvers
+    '''
+    def initial_values(self, vs):
+        values = self.values[0]
+        if vs is values:
+            return
+        for i, j in self.blocks():
+            values[i:j] = 0 if vs is None else vs[i:j]
+
+    '''
+    Run sweeps of backup(i, j, vs) -> new values of the states of block [i, j)
+    Each sweep reads the values of a file and writes the next ones in the other file
+    Return (v, number of sweeps done, final residual)
+    '''
+    def sweeps(self, backup, k, vs, tol):
+        self.initial_values(vs)
+        vs, new_vs = self.values
+
+        it = 0
+        residual = float('inf')
+        while it < k and residual > tol:
+            residual = 0
+            for i, j in self.blocks():
+                new_vs[i:j] = backup(i, j, vs)
+                residual = max(residual, np.max(np.abs(new_vs[i:j] - vs[i:j])))
+            vs, new_vs = new_vs, vs
+            it += 1
+
+        vs.flush()
+        self.values = [vs, new_vs]
+        return vs, it, residual
+
+    '''
+    Apply at most k steps of iterative policy evaluation, as MDP.iterative_policy_evaluation
+    policy.table can be a memory-mapped array (or a broadcast view for a uniform policy)
+    v_k+1(s) = sum(a in A) pi(a|s) * (R(s, a) + GAMMA * active(s) * sum(k) slip(a, k) v_k(moves(s, k)))
+
+    Return (v, number of iterations done, final residual)
+    v is a memory-mapped array, overwritten by the next call of a solver
+    '''
+    def iterative_policy_evaluation(self, policy, k, vs = None, tol = 0):
+
+        def backup(i, j, vs):
+            table = np.asarray(policy.table[i:j])
+            R_pi = np.sum(table * self.R[i:j], axis=1)
+            probs = self.active[i:j, None] * np.dot(table, self.slip)
+            return R_pi + self.gamma * np.sum(probs * vs[self.moves[i:j]], axis=1)
+
+        return self.sweeps(backup, k, vs, tol)
+
+    '''
+    Apply at most k steps of value iteration (Jacobi), as MDP.value_iteration
+    V_k+1(s) = max(a in A) (R(s, a) + GAMMA * P(a, s) * V_k)
+
+    Return (v, number of sweeps done, final residual)
+    v is a memory-mapped array, overwritten by the next call of a solver
+    '''
+    def value_iteration(self, k, vs = None, tol = 0):
+
+        def backup(i, j, vs):
+            return np.max(self.R[i:j] + self.gamma * self.p_dot(vs, i, j), axis=1)
 
-        return vs
+        return self.sweeps(backup, k, vs, tol)
@@ -0,0 +1,87 @@
+'''
+Per-episode (and per-step) metrics of the learners
+
+Learners take an optional callback, called at the end of every episode with
+callback(episode, length, ret, epsilon, delta):
+    episode: number of the episode (starts at 1)
+    length: number of steps of the episode
+    ret: sum of the rewards of the episode (score)
+    epsilon: exploration rate of the episode (None for policy evaluation)
+    delta: max |change| of a value (V or Q) during the episode (None if values are not updated)
+Without callback, nothing is measured
+
+The TD learners with a step loop (policy_evaluation_td0, sarsa, sarsa_offline,
+sarsa_lambda) also take an optional step_callback, called after every step with
+step_callback(episode, reward, delta):
+    reward: reward of the step
+    delta: |change| of the value updated by the step
+Monte-Carlo learners play a whole episode before updating anything and have no step hook
+'''
+
+import csv
+import json
+import time
+
+
+FIELDS = ['record', 'episode', 'length', 'return', 'epsilon', 'delta', 'steps', 'time']
+
+
+'''
+Callback that writes the metrics to a file, one line every `every` episodes
+JSON lines, or CSV if the path ends with .csv
+Each line also has the total number of steps and the wall time since the first callback
+(the first record has time 0, imports and world loading are not counted)
+every_steps: MetricsWriter.step is the step_callback, it writes a 'step' record every
+`every_steps` steps with the length, return and max delta of the episode so far
+(0 by default: no step records)
+'''
+class MetricsWriter:
+
+    def __init__(self, path, every = 1, every_steps = 0):
+        self.every = every
+        self.every_steps = every_steps
+        self.steps = 0
+        self.start = None
+        self.length = 0
+        self.ret = 0
+        self.delta = 0
+        self.file = open(path, 'w', newline='')
+        self.csv = None
+        if path.endswith('.csv'):
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(FIELDS)
+
+    def __call__(self, episode, length, ret, epsilon, delta):
+        if self.start is None:
+            self.start = time.time()
+        self.steps += length
+        self.length = 0
+        self.ret = 0
+        self.delta = 0
+        if episode % self.every != 0:
+            return
+
+        self.write(['episode', episode, length, float(ret), epsilon,
+                    None if delta is None else float(delta), self.steps])
+
+    def step(self, episode, reward, delta):
+        if self.start is None:
+            self.start = time.time()
+        self.length += 1
+        self.ret += reward
+        self.delta = max(self.delta, delta)
+        if self.every_steps <= 0 or (self.steps + self.length) % self.every_steps != 0:
+            return
+
+        self.write(['step', episode, self.length, float(self.ret), None,
+                    float(self.delta), self.steps + self.length])
+
+    def write(self, row):
+        row.append(time.time() - self.start)
+        if self.csv is not None:
+            self.csv.writerow(['' if v is None else v for v in row])
+        else:
+            self.file.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+
+    def close(self):
+        self.file.close()
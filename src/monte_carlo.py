@@ -3,7 +3,71 @@ Monte carlo methods with reinforcement learning deep mind tutorial
 '''
 
 import numpy as np
-from policy import Policy
+from policy import EGreedyPolicy, Policy
+from qtable import HashedQTable
+
+
+'''
+Trajectory of one episode: states, actions and rewards stored in preallocated arrays
+states[t], actions[t]: state and action at time step t
+rewards[t]: reward received after taking actions[t]
+Arrays are doubled when full, so recording an episode of length T costs O(T)
+'''
+class EpisodeBuffer:
+
+    def __init__(self, capacity = 1024):
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity)
+        self.size = 0
+
+    def clear(self):
+        self.size = 0
+
+    def add(self, s, a, reward):
+        if self.size == len(self.states):
+            self.states = np.concatenate([self.states, np.zeros_like(self.states)])
+            self.actions = np.concatenate([self.actions, np.zeros_like(self.actions)])
+            self.rewards = np.concatenate([self.rewards, np.zeros_like(self.rewards)])
+
+        self.states[self.size] = s
+        self.actions[self.size] = a
+        self.rewards[self.size] = reward
+        self.size += 1
+
+    '''
+    Play one game following policy and record it
+    '''
+    def play(self, w, policy):
+        self.clear()
+        w.reset()
+
+        while not w.finished:
+            s = w.player.cell.pos
+            a = policy.get_action(s)
+            reward = w.take_action(a)
+            self.add(s, a, reward)
+
+    '''
+    Compute the return G_t of every time step, in one backward pass
+    G_t = R_t+1 + gamma * G_t+1
+    '''
+    def returns(self, gamma):
+        rewards = self.rewards[:self.size].tolist()
+        g = 0.0
+        for t in range(self.size - 1, -1, -1):
+            g = rewards[t] + gamma * g
+            rewards[t] = g
+        return np.array(rewards)
+
+    '''
+    Return the mask of time steps that are the first visit of their state
+    '''
+    def first_visits(self):
+        mask = np.zeros(self.size, dtype=bool)
+        _, first = np.unique(self.states[:self.size], return_index=True)
+        mask[first] = True
+        return mask
 
 '''
 Compute an approximation of v_pi by running lots of simulations following policy pi
@@ -15,43 +79,50 @@ first time t that state s is visited:
   S(s) += G_t
 
 V_pi(s) = S(s) / N(s)
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving N and S
 '''
-def policy_evaluation_first_visit(w, policy, nsimus, gamma):
+def policy_evaluation_first_visit(w, policy, nsimus, gamma, callback = None, checkpoint = None):
+    N, S = first_visit_statistics(w, policy, nsimus, gamma, callback, checkpoint)
+    return values_from_statistics(N, S)
+
+'''
+Play nsimus games and return the statistics (N, S) of first visit Monte-Carlo
+Statistics of several runs can be summed
+'''
+def first_visit_statistics(w, policy, nsimus, gamma, callback = None, checkpoint = None):
 
     n = w.width * w.height
 
     N = np.zeros((n))
     S = np.zeros((n))
 
-    for _ in range(nsimus):
+    episode = EpisodeBuffer()
 
-        #array of tuple (gamma^n (current discount), total reward)
-        #one for each state, since first visit
-        returns = [None] * n
+    start = checkpoint.restore(N=N, S=S) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
 
-        w.reset()
+        episode.play(w, policy)
+        mask = episode.first_visits()
+        states = episode.states[:episode.size][mask]
 
-        while not w.finished:
-            s = w.player.cell.pos
-            a = policy.get_action(s)
-            reward = w.take_action(a)
+        N[states] += 1
+        S[states] += episode.returns(gamma)[mask]
 
-            if returns[s] == None:
-                returns[s] = (1, 0)
+        if callback is not None:
+            callback(k, episode.size, w.score, None, None)
+        if checkpoint is not None:
+            checkpoint.step(k, N=N, S=S)
 
-            for i in range(n):
-                if returns[i] != None:
-                    returns[i] = (returns[i][0] * gamma, returns[i][1] + returns[i][0] * reward)
+    return N, S
 
-        for s in range(n):
-            if returns[s] != None:
-                N[s] += 1
-                S[s] += returns[s][1]
-
-    vs = np.zeros((n))
-    for s in range(n):
-        if N[s] != 0:
-            vs[s] = S[s] / N[s]
+'''
+V_pi(s) = S(s) / N(s), or 0 if s was never visited
+'''
+def values_from_statistics(N, S):
+    vs = np.zeros(len(N))
+    visited = N != 0
+    vs[visited] = S[visited] / N[visited]
     return vs
     
 
@@ -65,42 +136,41 @@ every time t that state s is visited:
   S(s) += G_t
 
 V_pi(s) = S(s) / N(s)
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving N and S
 '''
-def policy_evaluation_every_visit(w, policy, nsimus, gamma):
+def policy_evaluation_every_visit(w, policy, nsimus, gamma, callback = None, checkpoint = None):
+    N, S = every_visit_statistics(w, policy, nsimus, gamma, callback, checkpoint)
+    return values_from_statistics(N, S)
+
+'''
+Play nsimus games and return the statistics (N, S) of every visit Monte-Carlo
+Statistics of several runs can be summed
+'''
+def every_visit_statistics(w, policy, nsimus, gamma, callback = None, checkpoint = None):
 
     n = w.width * w.height
 
     N = np.zeros((n))
     S = np.zeros((n))
 
-    for _ in range(nsimus):
+    episode = EpisodeBuffer()
 
-        #array of tuple (gamma^n (current discount), total reward, start step)
-        #one entry for each time step
-        returns = []
+    start = checkpoint.restore(N=N, S=S) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
 
-        w.reset()
-
-        while not w.finished:
-            s = w.player.cell.pos
-            a = policy.get_action(s)
-            reward = w.take_action(a)
+        episode.play(w, policy)
+        states = episode.states[:episode.size]
 
-            returns.append((1, 0, s))
-            for t in range(len(returns)):
-                returns[t] = (returns[t][0] * gamma, returns[t][1] + returns[t][0] * reward, returns[t][2])
+        np.add.at(N, states, 1)
+        np.add.at(S, states, episode.returns(gamma))
 
-        
-        for t in range(len(returns)):
-            s = returns[t][2]
-            N[s] += 1
-            S[s] += returns[t][1]
+        if callback is not None:
+            callback(k, episode.size, w.score, None, None)
+        if checkpoint is not None:
+            checkpoint.step(k, N=N, S=S)
 
-    vs = np.zeros((n))
-    for s in range(n):
-        if N[s] != 0:
-            vs[s] = S[s] / N[s]
-    return vs
+    return N, S
 
 
 '''
@@ -110,34 +180,38 @@ alpha: learning rate
 after each simulation, for each time step t:
   v_pi(S_t) = v_pi(S_t) + alpha * (G_t -v_pi(S_t))
 
+vs: initial values (0 by default)
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving vs
 '''
-def policy_evaluation_update(w, policy, alpha, nsimus, gamma):
+def policy_evaluation_update(w, policy, alpha, nsimus, gamma, vs = None, callback = None,
+                             checkpoint = None):
 
     n = w.width * w.height
-    vs = np.zeros((n))
+    if vs is None:
+        vs = np.zeros((n))
+    vs = np.array(vs, dtype=np.float64)
 
-    for _ in range(nsimus):
+    episode = EpisodeBuffer()
 
-        #array of tuple (gamma^n (current discount), total reward, start step)
-        #one entry for each time step
-        returns = []
+    start = checkpoint.restore(vs=vs) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
 
-        w.reset()
-
-        while not w.finished:
-            s = w.player.cell.pos
-            a = policy.get_action(s)
-            reward = w.take_action(a)
+        episode.play(w, policy)
+        returns = episode.returns(gamma)
+        delta = 0
 
-            returns.append((1, 0, s))
-            for t in range(len(returns)):
-                returns[t] = (returns[t][0] * gamma, returns[t][1] + returns[t][0] * reward, returns[t][2])
+        for t in range(episode.size):
+            s_t = episode.states[t]
+            change = alpha * (returns[t] - vs[s_t])
+            vs[s_t] += change
+            if callback is not None:
+                delta = max(delta, abs(change))
 
-        
-        for t in range(len(returns)):
-            s_t = returns[t][2]
-            g_t = returns[t][1] 
-            vs[s_t] += alpha * (g_t - vs[s_t])
+        if callback is not None:
+            callback(k, episode.size, w.score, None, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, vs=vs)
 
 
     return vs
@@ -146,10 +220,13 @@ def policy_evaluation_update(w, policy, alpha, nsimus, gamma):
 '''
 Implement monte carlo control with GLIE policy
 Evaluate Q actions from each episode k with monte carlo
-Compute e-greedy policy after each episode k with e = 1/k
+Follow e-greedy policy on Q after each episode k with e = 1/k
+(a view over Q, no table is built during learning)
 Converges to optimal policy
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q and N
 '''
-def glie_control(w, nsimus, gamma, policy = None):
+def glie_control(w, nsimus, gamma, policy = None, callback = None, checkpoint = None):
 
     n = w.width * w.height
     N = np.zeros((n, 4))
@@ -157,31 +234,88 @@ def glie_control(w, nsimus, gamma, policy = None):
     if policy == None:
         policy = Policy.build_deterministic([0] * n)
 
-    for k in range(1, nsimus + 1):
+    episode = EpisodeBuffer()
+    egreedy = EGreedyPolicy(Q, 1)
 
-        #array of tuple (gamma^n (current discount), total reward, start step, start action)
-        #one entry for each time step
-        returns = []
+    start = checkpoint.restore(Q=Q, N=N) if checkpoint is not None else 1
+    if start > 1:
+        egreedy.e = 1 / (start - 1)
+        policy = egreedy
 
-        w.reset()
+    for k in range(start, nsimus + 1):
 
-        while not w.finished:
-            s = w.player.cell.pos
-            a = policy.get_action(s)
-            reward = w.take_action(a)
+        episode.play(w, policy)
+        states = episode.states[:episode.size]
+        actions = episode.actions[:episode.size]
+
+        #incremental mean of all returns of (s, a) in this episode
+        #same as Q(s, a) += (G_t - Q(s, a)) / N(s, a) for each step t
+        keys, index = np.unique(states * 4 + actions, return_inverse=True)
+        counts = np.bincount(index)
+        sums = np.bincount(index, weights=episode.returns(gamma))
+        s_t = keys // 4
+        a_t = keys % 4
+        N[s_t, a_t] += counts
+        change = (sums - counts * Q[s_t, a_t]) / N[s_t, a_t]
+        Q[s_t, a_t] += change
+
+        if callback is not None:
+            #first episode follows the initial policy
+            callback(k, episode.size, w.score, None if k == 1 else egreedy.e,
+                     np.max(np.abs(change)))
+
+        egreedy.e = 1 / k
+        policy = egreedy
 
-            returns.append((1, 0, s, a))
-            for t in range(len(returns)):
-                returns[t] = (returns[t][0] * gamma, returns[t][1] + returns[t][0] * reward, returns[t][2], returns[t][3])
+        if checkpoint is not None:
+            checkpoint.step(k, Q=Q, N=N)
 
-        for t in range(len(returns)):
-            s_t = returns[t][2]
-            g_t = returns[t][1]
-            a_t = returns[t][3]
-            N[s_t][a_t] += 1
-            Q[s_t][a_t] += (g_t - Q[s_t][a_t]) / N[s_t][a_t]
 
-        policy = Policy.build_egreedy(Policy.qvs_to_table(Q), 1 / k)
+    return Policy.build_deterministic(Policy.qvs_to_table(Q))
 
 
-    return Policy.build_deterministic(policy.qvs_to_table(Q))
+'''
+GLIE Monte-Carlo control over full game states (world.World.state_key)
+Episodes are played e-greedy on Q with e = 1/k
+Q: HashedQTable updated in-place (empty by default), returned, N(s, a) is Q.counts
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q
+'''
+def glie_control_full(w, nsimus, gamma, Q = None, callback = None, checkpoint = None):
+
+    if Q is None:
+        Q = HashedQTable()
+
+    episode = EpisodeBuffer()
+
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
+
+        episode.clear()
+        w.reset()
+        while not w.finished:
+            s = w.state_key()
+            a = Policy.e_greedy_action_from_qvs(Q.index(s), 1 / k, Q.values)
+            reward = w.take_action(a)
+            episode.add(s, a, reward)
+
+        pairs = np.stack([episode.states[:episode.size], episode.actions[:episode.size]], axis=1)
+        pairs, index = np.unique(pairs, axis=0, return_inverse=True)
+        index = index.reshape(-1)
+        counts = np.bincount(index)
+        sums = np.bincount(index, weights=episode.returns(gamma))
+
+        delta = 0
+        for (s, a), count, total in zip(pairs.tolist(), counts, sums):
+            i = Q.index(s)
+            Q.counts[i][a] += count
+            change = (total - count * Q.values[i][a]) / Q.counts[i][a]
+            Q.values[i][a] += change
+            delta = max(delta, abs(change))
+
+        if callback is not None:
+            callback(k, episode.size, w.score, 1 / k, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, Q=Q)
+
+    return Q
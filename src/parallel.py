@@ -0,0 +1,161 @@
+'''
+Run Monte-Carlo and TD policy evaluation with a pool of processes
+Each worker process loads its own World from the world file
+Games are split in tasks, each task has its own seed, so the results only depend
+on the seed and the number of workers
+
+Also run SARSA and Q-Learning with several actors processes sharing the same Q table
+'''
+
+import multiprocessing
+import numpy as np
+import random
+
+import monte_carlo
+from policy import Policy
+import td_learning
+import world
+
+
+_world = None
+
+def _init_worker(path):
+    global _world
+    _world = world.World(path)
+
+def _seed_task(seed):
+    random.seed(seed)
+    np.random.seed(seed % (2 ** 32))
+
+def _run_statistics(args):
+    fn, policy, nsimus, gamma, seed = args
+    _seed_task(seed)
+    return fn(_world, policy, nsimus, gamma)
+
+def _run_batch(args):
+    fn, policy, alpha, nsimus, gamma, vs, seed = args
+    _seed_task(seed)
+    return fn(_world, policy, alpha, nsimus, gamma, vs) - vs
+
+
+'''
+Split nsimus games in nparts tasks
+'''
+def split_games(nsimus, nparts):
+    return [nsimus // nparts + (1 if i < nsimus % nparts else 0) for i in range(nparts)]
+
+'''
+Return the seed of each task
+'''
+def task_seeds(seed, ntasks):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 2 ** 31 - 1, ntasks).tolist()
+
+
+'''
+Monte-Carlo policy evaluation (first visit or every visit) with workers processes
+Each worker plays a share of the games and returns its statistics (N, S)
+They are summed to compute V_pi(s) = S(s) / N(s)
+'''
+def policy_evaluation_mc(path, policy, nsimus, gamma, workers, first_visit = True, seed = None):
+
+    if first_visit:
+        fn = monte_carlo.first_visit_statistics
+    else:
+        fn = monte_carlo.every_visit_statistics
+
+    parts = split_games(nsimus, workers)
+    seeds = task_seeds(seed, workers)
+    tasks = [(fn, policy, part, gamma, s) for part, s in zip(parts, seeds)]
+
+    with multiprocessing.Pool(workers, _init_worker, (path,)) as pool:
+        stats = pool.map(_run_statistics, tasks)
+
+    N = sum(st[0] for st in stats)
+    S = sum(st[1] for st in stats)
+    return monte_carlo.values_from_statistics(N, S)
+
+'''
+Incremental policy evaluation (every visit Monte-Carlo with alpha, or TD(0))
+with workers processes
+Games are played by rounds: at each round, every worker starts from the current values,
+plays batch games, and returns how much its values changed
+The mean of all these changes is added to the values (same as averaging the values of all workers)
+n: number of states of the world, only the workers load the world
+'''
+def policy_evaluation_batches(fn, path, n, policy, alpha, nsimus, gamma, workers,
+                              batch = 100, seed = None):
+
+    vs = np.zeros(n)
+    nrounds = (nsimus + batch * workers - 1) // (batch * workers)
+    seeds = task_seeds(seed, nrounds * workers)
+    done = 0
+
+    with multiprocessing.Pool(workers, _init_worker, (path,)) as pool:
+        for r in range(nrounds):
+            parts = split_games(min(batch * workers, nsimus - done), workers)
+            done += sum(parts)
+            tasks = [(fn, policy, alpha, part, gamma, vs, seeds[r * workers + i])
+                     for i, part in enumerate(parts) if part > 0]
+            deltas = pool.map(_run_batch, tasks)
+            vs = vs + sum(deltas) / len(deltas)
+
+    return vs
+
+def policy_evaluation_update(path, n, policy, alpha, nsimus, gamma, workers,
+                             batch = 100, seed = None):
+    return policy_evaluation_batches(monte_carlo.policy_evaluation_update, path, n, policy,
+                                     alpha, nsimus, gamma, workers, batch, seed)
+
+def policy_evaluation_td0(path, n, policy, alpha, nsimus, gamma, workers,
+                          batch = 100, seed = None):
+    return policy_evaluation_batches(td_learning.policy_evaluation_td0, path, n, policy,
+                                     alpha, nsimus, gamma, workers, batch, seed)
+
+
+def _run_actor(fn, path, shared_q, alpha, nsimus, gamma, decay, seed):
+    _seed_task(seed)
+    w = world.World(path)
+    Q = np.frombuffer(shared_q, dtype=np.float64).reshape((w.width * w.height, 4))
+    fn(w, alpha, nsimus, gamma, Q, decay)
+
+'''
+Run actors processes, each one plays its share of the games on its own World
+All actors read and update the same Q table in shared memory, without locks
+Raise RuntimeError if an actor fails
+Actor i explores with e = 1 / (1 + (k - 1) * decay_i), k its own number of games,
+decay_i = (i + 1) / actors: the last actor follows e = 1 / k, the others explore more
+'''
+def td_control(fn, path, alpha, nsimus, gamma, actors, seed = None):
+
+    w = world.World(path)
+    n = w.width * w.height
+    shared_q = multiprocessing.RawArray('d', n * 4)
+
+    parts = split_games(nsimus, actors)
+    seeds = task_seeds(seed, actors)
+    procs = []
+    for i in range(actors):
+        decay = (i + 1) / actors
+        proc = multiprocessing.Process(target=_run_actor,
+                                       args=(fn, path, shared_q, alpha, parts[i], gamma,
+                                             decay, seeds[i]))
+        proc.start()
+        procs.append(proc)
+
+    for proc in procs:
+        proc.join()
+
+    failed = [i for i, proc in enumerate(procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError('actors {} exited with codes {}, Q is only partly trained'
+                           .format(failed, [procs[i].exitcode for i in failed]))
+
+    Q = np.frombuffer(shared_q, dtype=np.float64).reshape((n, 4)).copy()
+    return Policy.build_deterministic(Policy.qvs_to_table(Q))
+
+def sarsa(path, alpha, nsimus, gamma, actors, seed = None):
+    return td_control(td_learning.sarsa, path, alpha, nsimus, gamma, actors, seed)
+
+def sarsa_offline(path, alpha, nsimus, gamma, actors, seed = None):
+    return td_control(td_learning.sarsa_offline, path, alpha, nsimus, gamma, actors, seed)
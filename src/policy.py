@@ -1,3 +1,4 @@
+import bisect
 import numpy as np
 import random
 import world
@@ -18,8 +19,7 @@ class Policy:
 
         n = len(table)
         table2 = np.zeros((n, 4))
-        for s in range(n):
-            table2[s][table[s]] = 1
+        table2[np.arange(n), table] = 1
         return Policy(table2)
 
     '''
@@ -32,15 +32,8 @@ class Policy:
     @staticmethod
     def build_egreedy(table, e):
         n = len(table)
-        table2 = np.zeros((n, 4))
-
-        for s in range(n):
-            for a in range(4):
-                if table[s] == a:
-                    table2[s][a] = 1 - e + (e / 4)
-                else:
-                    table2[s][a] = e / 4
-
+        table2 = np.full((n, 4), e / 4)
+        table2[np.arange(n), table] = 1 - e + (e / 4)
         return Policy(table2)
 
     '''
@@ -50,11 +43,7 @@ class Policy:
     '''
     @staticmethod
     def qvs_to_table(qvs):
-        n = qvs.shape[0]
-        policy = [0] * n
-        for s in range(n):
-            policy[s] = np.argmax(qvs[s])
-        return policy
+        return np.argmax(qvs, axis=1)
 
     '''
     Return the best action in state s following q-values
@@ -79,34 +68,41 @@ class Policy:
     
     def __init__(self, table):
         self.table = table
-        self.probs = None
+        self.cumul = None
 
+    '''
+    Compute the sampling table of all states in one pass, done at the first sampling
+    cumul[s][a] = pi(0|s) + ... + pi(a|s), rows are normalized to sum to 1
+    Rows that sum to 0 (no action possible) are sampled uniformly
+    cumul_list: same table as python lists, faster to read one state at a time
+    '''
     def compute_probs(self):
-        n = len(self.table)
-        self.probs = [None] * n
+        table = np.asarray(self.table, dtype=np.float64)
+        table = np.where(table.sum(axis=1)[:, None] > 0, table, 1.)
+        cumul = np.cumsum(table, axis=1)
+        cumul /= cumul[:, -1:]
+        self.cumul = cumul
+        self.cumul_list = cumul.tolist()
 
-        for s in range(n):
-            probs = [(i, self.table[s][i]) for i in range(4)]
-            probs.sort(key = lambda x: - x[1])
-            self.probs[s] = probs
-            
     '''
     Select an action acording to the state and the stochastic policy
     '''
     def get_action(self, s):
-        if self.probs == None:
+        if self.cumul is None:
             self.compute_probs()
-            
-        probs = self.probs[s]
-        val = random.random()
-        step = probs[0][1]
 
-        i = 0
-        while val > step:
-            i += 1
-            step += probs[i][1]
+        return min(bisect.bisect_right(self.cumul_list[s], random.random()), 3)
 
-        return probs[i][0]
+    '''
+    Select an action for each state of an array of states
+    rng: numpy random generator (np.random by default)
+    '''
+    def get_actions(self, states, rng = np.random):
+        if self.cumul is None:
+            self.compute_probs()
+
+        vals = rng.rand(len(states))
+        return np.minimum(np.sum(self.cumul[states] <= vals[:, None], axis=1), 3)
 
     '''
     Play one game following policy
@@ -120,27 +116,41 @@ class Policy:
         return w.score
 
     '''
-    Play multiple games with policy and print states
+    Play at most nsimus games with policy, stop earlier when the confidence interval
+    of the mean score is smaller than ci_width
+    Return the statistics of the scores (scoring.ScoreStats)
     '''
-    def play_games(self, w, nsimus):
-        sum_score = 0
-        min_score = float("inf")
-        max_score = - float("inf")
-
-        for _ in range(nsimus):
-            score = self.play_game(w)
-            sum_score += score
-            min_score =min(min_score, score)
-            max_score = max(max_score, score)
-
-        print("min = " + str(min_score))
-        print("av  = " + str(sum_score / nsimus))
-        print("max = " + str(max_score))
-
-
+    def play_games(self, w, nsimus, ci_width = None, confidence = 0.95):
+        import scoring
+        return scoring.play_games(w, self, nsimus, ci_width, confidence)
 
     def __eq__(self, other):
         if not isinstance(other, Policy):
             raise TypeError
         else:
             return np.array_equal(self.table, other.table)
+
+
+'''
+e-greedy policy over live q-values, nothing is computed when it is built
+Actions are drawn from the current values of qvs, so the policy follows the updates of qvs
+pi(a|s) = 1 - e + e/4 if a is best action, e / 4 otherwhise
+The table is only built when it is read
+'''
+class EGreedyPolicy(Policy):
+
+    def __init__(self, qvs, e):
+        self.qvs = qvs
+        self.e = e
+
+    @property
+    def table(self):
+        return Policy.build_egreedy(Policy.qvs_to_table(self.qvs), self.e).table
+
+    def get_action(self, s):
+        return Policy.e_greedy_action_from_qvs(s, self.e, self.qvs)
+
+    def get_actions(self, states, rng = np.random):
+        explore = rng.rand(len(states)) < self.e
+        return np.where(explore, rng.randint(0, 4, len(states)),
+                        np.argmax(self.qvs[states], axis=1))
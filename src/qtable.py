@@ -0,0 +1,151 @@
+'''
+Q values over full game states (world.World.state_key)
+The number of full states is too big for a dense table, so only visited states are stored,
+in a hash table with open addressing over numpy arrays
+'''
+
+import numpy as np
+import random
+
+
+'''
+Hash table state key => row of Q values
+keys[i], values[i], counts[i]: key, Q(s, *) and number of updates of (s, *) stored in slot i
+Linear probing, at most PROBES slots are looked at for a key
+The table is doubled when half full or when a probe window is full, until max_capacity
+When max_capacity is reached, a new state replaces the least updated one of its probe window,
+so the memory used is bounded
+Slots are key & (capacity - 1): capacity and max_capacity must be powers of 2
+'''
+class HashedQTable:
+
+    PROBES = 16
+
+    def __init__(self, capacity = 1024, max_capacity = 1 << 20):
+        for value in (capacity, max_capacity):
+            if value < 1 or value & (value - 1) != 0:
+                raise ValueError('capacity must be a power of 2: {}'.format(value))
+        self.max_capacity = max(max_capacity, capacity)
+        self.size = 0
+        self.alloc(capacity)
+
+    def alloc(self, capacity):
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.keys = np.zeros(capacity, dtype=np.int64)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.values = np.zeros((capacity, 4))
+        self.counts = np.zeros((capacity, 4), dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    '''
+    Return the slot of key, or -1 if key is not stored
+    '''
+    def find(self, key):
+        i = key & self.mask
+        for _ in range(self.PROBES):
+            if not self.used[i]:
+                return -1
+            if self.keys[i] == key:
+                return i
+            i = (i + 1) & self.mask
+        return -1
+
+    '''
+    Return the slot of key, inserted with Q(s, *) = 0 if not stored yet
+    Slots change when the table grows: a slot is only valid until the next call
+    '''
+    def index(self, key):
+        i = key & self.mask
+        worst = i
+        for _ in range(self.PROBES):
+            if not self.used[i]:
+                if 2 * (self.size + 1) > self.capacity and self.capacity < self.max_capacity:
+                    self.grow()
+                    return self.index(key)
+                self.size += 1
+                self.used[i] = True
+                self.set_slot(i, key)
+                return i
+            if self.keys[i] == key:
+                return i
+            if self.counts[i].sum() < self.counts[worst].sum():
+                worst = i
+            i = (i + 1) & self.mask
+
+        #probe window full: grow, or evict the least updated state
+        if self.capacity < self.max_capacity:
+            self.grow()
+            return self.index(key)
+        self.set_slot(worst, key)
+        return worst
+
+    def set_slot(self, i, key):
+        self.keys[i] = key
+        self.values[i] = 0
+        self.counts[i] = 0
+
+    def grow(self):
+        keys = self.keys[self.used]
+        values = self.values[self.used]
+        counts = self.counts[self.used]
+        self.size = 0
+        self.alloc(min(self.capacity * 2, self.max_capacity))
+        for key, qs, ns in zip(keys.tolist(), values, counts):
+            i = self.index(key)
+            self.values[i] = qs
+            self.counts[i] = ns
+
+    '''
+    Arrays of the table, to save it in a checkpoint
+    '''
+    def get_arrays(self):
+        return {'keys': self.keys.copy(), 'used': self.used.copy(), 'values': self.values.copy(),
+                'counts': self.counts.copy(), 'size': np.array(self.size)}
+
+    '''
+    Restore the table saved by get_arrays
+    '''
+    def set_arrays(self, arrays):
+        self.alloc(len(arrays['keys']))
+        self.max_capacity = max(self.max_capacity, self.capacity)
+        self.keys[:] = arrays['keys']
+        self.used[:] = arrays['used']
+        self.values[:] = arrays['values']
+        self.counts[:] = arrays['counts']
+        self.size = int(arrays['size'])
+
+    '''
+    Return Q(s, *) of key, 0 for unknown states
+    '''
+    def get(self, key):
+        i = self.find(key)
+        return self.values[i] if i != -1 else np.zeros(4)
+
+    '''
+    Return the best action of the current state of w, random for unknown states
+    '''
+    def greedy_action(self, w):
+        i = self.find(w.state_key())
+        if i == -1:
+            return random.randint(0, 3)
+        return np.argmax(self.values[i])
+
+    '''
+    Play one game following the greedy policy
+    '''
+    def play_game(self, w):
+        w.reset()
+        while not w.finished:
+            w.take_action(self.greedy_action(w))
+        return w.score
+
+    '''
+    Play multiple games with the greedy policy
+    Return the statistics of the scores (scoring.ScoreStats)
+    '''
+    def play_games(self, w, nsimus, ci_width = None, confidence = 0.95):
+        import scoring
+        return scoring.play_games(w, self, nsimus, ci_width, confidence)
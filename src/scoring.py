@@ -0,0 +1,151 @@
+'''
+Score a policy by playing games, with streaming statistics of the scores
+Games can be played by a pool of processes, and stop as soon as the confidence interval
+of the mean score is small enough
+'''
+
+from collections import Counter
+import math
+import multiprocessing
+from scipy import stats
+
+import parallel
+
+
+#never stop before this number of games, the variance is not reliable before
+MIN_GAMES = 30
+
+
+'''
+Streaming statistics of scores
+mean and variance are updated with Welford's algorithm, statistics of several
+runs can be merged (Chan's formula)
+histogram[score]: number of games that ended with score
+'''
+class ScoreStats:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = float('inf')
+        self.max = - float('inf')
+        self.histogram = Counter()
+        self.converged = False
+
+    def add(self, score):
+        self.count += 1
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (score - self.mean)
+        self.min = min(self.min, score)
+        self.max = max(self.max, score)
+        self.histogram[score] += 1
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram.update(other.histogram)
+
+    '''
+    Unbiased variance of the scores
+    '''
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    '''
+    Half width of the confidence interval of the mean score (normal approximation)
+    '''
+    def ci(self, confidence = 0.95):
+        if self.count < 2:
+            return float('inf')
+        z = stats.norm.ppf(0.5 + confidence / 2)
+        return z * self.std() / math.sqrt(self.count)
+
+    '''
+    Return the smallest score such that a fraction q of the games have a lower or equal score
+    '''
+    def quantile(self, q):
+        total = 0
+        for score in sorted(self.histogram):
+            total += self.histogram[score]
+            if total >= q * self.count:
+                return score
+        return self.max
+
+    '''
+    True when the confidence interval of the mean is smaller than ci_width
+    '''
+    def is_precise(self, ci_width, confidence = 0.95):
+        return self.count >= MIN_GAMES and 2 * self.ci(confidence) <= ci_width
+
+    def __str__(self):
+        return ('games = {}, mean = {}, std = {}, ci95 = +/-{}\n'
+                'min = {}, q05 = {}, median = {}, q95 = {}, max = {}').format(
+                    self.count, self.mean, self.std(), self.ci(),
+                    self.min, self.quantile(0.05), self.quantile(0.5),
+                    self.quantile(0.95), self.max)
+
+
+'''
+Play at most nsimus games on w, serially
+player: object with a play_game(w) method returning the score (Policy, HashedQTable)
+ci_width: stop when the confidence interval of the mean score is smaller
+Return the ScoreStats of the games
+'''
+def play_games(w, player, nsimus, ci_width = None, confidence = 0.95):
+    res = ScoreStats()
+    for _ in range(nsimus):
+        res.add(player.play_game(w))
+        if ci_width is not None and res.is_precise(ci_width, confidence):
+            res.converged = True
+            break
+    return res
+
+def _run_games(args):
+    player, nsimus, seed = args
+    parallel._seed_task(seed)
+    return play_games(parallel._world, player, nsimus)
+
+
+'''
+Play at most nsimus games of the world file path with workers processes
+Games are played by tasks of batch games, each with its own seed
+Tasks results are merged in order, and the scoring stops at the first task after which
+the confidence interval of the mean score is smaller than ci_width,
+so the result only depends on the seed (not on the number of workers)
+Return the ScoreStats of the games
+'''
+def score_policy(path, player, nsimus, workers = 1, ci_width = None, confidence = 0.95,
+                 batch = 100, seed = None):
+
+    parts = [batch] * (nsimus // batch) + ([nsimus % batch] if nsimus % batch else [])
+    seeds = parallel.task_seeds(seed, len(parts))
+    tasks = [(player, part, s) for part, s in zip(parts, seeds)]
+    res = ScoreStats()
+
+    def merge(results):
+        for part in results:
+            res.merge(part)
+            if ci_width is not None and res.is_precise(ci_width, confidence):
+                res.converged = True
+                break
+
+    if workers <= 1:
+        parallel._init_worker(path)
+        merge(_run_games(task) for task in tasks)
+    else:
+        with multiprocessing.Pool(workers, parallel._init_worker, (path,)) as pool:
+            merge(pool.imap(_run_games, tasks))
+
+    return res
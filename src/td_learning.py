@@ -4,18 +4,29 @@ Temporal difference learning methods with reinforcement learning deep mind tutor
 
 import numpy as np
 from policy import Policy
+from qtable import HashedQTable
 
 '''
 Play n games in order to evaluate a policy
 sample = R(s, pi(s), s') + gamma * v(s')
 v(s) = v(s) + ALPHA * (sample - v(s)) 
+vs: initial values (0 by default)
+callback: called after each episode (see metrics)
+step_callback: called after each step (see metrics)
+checkpoint: checkpoint.Checkpointer saving vs
 '''
-def policy_evaluation_td0(w, policy, alpha, nsimus, gamma):
+def policy_evaluation_td0(w, policy, alpha, nsimus, gamma, vs = None, callback = None,
+                          checkpoint = None, step_callback = None):
 
-    vs = np.zeros(w.width * w.height)
+    if vs is None:
+        vs = np.zeros(w.width * w.height)
+    vs = np.array(vs, dtype=np.float64)
 
-    for _ in range(nsimus):
+    start = checkpoint.restore(vs=vs) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
         w.reset()
+        length = 0
+        delta = 0
         while not w.finished:
             s = w.player.cell.pos
             a = policy.get_action(s)
@@ -23,9 +34,51 @@ def policy_evaluation_td0(w, policy, alpha, nsimus, gamma):
             s2 = w.player.cell.pos
 
             sample = reward + gamma * vs[s2]
-            vs[s] = vs[s] + alpha * (sample - vs[s])
+            change = alpha * (sample - vs[s])
+            vs[s] = vs[s] + change
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(change))
+            if step_callback is not None:
+                step_callback(k, reward, abs(change))
+
+        if callback is not None:
+            callback(k, length, w.score, None, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, vs=vs)
 
     return vs
+
+'''
+Vectorized version of policy_evaluation_td0
+Play n games on a VecWorld, all envs are updated at the same time
+Envs in the same state are computed from the same old value, so their updates are
+averaged: V(s) moves by alpha towards the mean sample, as for a single update
+'''
+def policy_evaluation_td0_vec(vw, policy, alpha, nsimus, gamma):
+
+    n = vw.width * vw.height
+    vs = np.zeros(n)
+
+    while vw.finished_games < nsimus:
+        s = vw.pos
+        a = policy.get_actions(s, vw.rng)
+        s2, reward, _ = vw.take_action(a)
+
+        sample = reward + gamma * vs[s2]
+        vs += mean_updates(s, alpha * (sample - vs[s]), n)
+
+    return vs
+
+'''
+Return the mean of the updates of each entry, 0 for entries without update
+update[i] is an update of the entry index[i]
+'''
+def mean_updates(index, update, n):
+    counts = np.bincount(index, minlength=n)
+    sums = np.bincount(index, weights=update, minlength=n)
+    return sums / np.maximum(counts, 1)
 '''
 Play n games using SARSA (State - Action - Reward - State - Action)
 Compute Q values using TD(0)
@@ -35,29 +88,104 @@ alpha : learning rate, should decrease over time
 
 Q(s, a) chosen arbitriraly, except Q(terminal,*) = 0
 Q(s, a) = Q(s, a) + alpha * (R + gamma * Q(s', a') - Q(s, a))
+
+Q: table updated in-place (zeros by default)
+decay: e = 1 / (1 + (k - 1) * decay), default is e = 1 / k
+callback: called after each episode (see metrics)
+step_callback: called after each step (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q
 '''
-def sarsa(w, alpha, nsimus, gamma):
+def sarsa(w, alpha, nsimus, gamma, Q = None, decay = 1, callback = None, checkpoint = None,
+          step_callback = None):
 
     n = w.width  * w.height
-    Q = np.zeros((n, 4))
+    if Q is None:
+        Q = np.zeros((n, 4))
 
-    for k in range(1, nsimus + 1):
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
         w.reset()
         s = w.player.cell.pos
-        a = Policy.e_greedy_action_from_qvs(s, 1 / k, Q)
+        epsilon = 1 / (1 + (k - 1) * decay)
+        a = Policy.e_greedy_action_from_qvs(s, epsilon, Q)
+        length = 0
+        delta = 0
         
         while not w.finished:
             reward = w.take_action(a)
             s2 = w.player.cell.pos
-            a2 = Policy.e_greedy_action_from_qvs(s2, 1 / k, Q)
+            a2 = Policy.e_greedy_action_from_qvs(s2, epsilon, Q)
 
-            Q[s][a] += alpha * (reward + gamma * Q[s2][a2] - Q[s][a])
+            change = alpha * (reward + gamma * Q[s2][a2] - Q[s][a])
+            Q[s][a] += change
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(change))
+            if step_callback is not None:
+                step_callback(k, reward, abs(change))
 
             s = s2
             a = a2
 
+        if callback is not None:
+            callback(k, length, w.score, epsilon, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, Q=Q)
+
     return Policy.build_deterministic(Policy.qvs_to_table(Q))
 
+'''
+SARSA over full game states (world.World.state_key) instead of player positions
+Q: HashedQTable updated in-place (empty by default), returned
+Terminal states are not stored, Q(terminal, *) = 0
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q
+'''
+def sarsa_full(w, alpha, nsimus, gamma, Q = None, decay = 1, callback = None, checkpoint = None):
+
+    if Q is None:
+        Q = HashedQTable()
+
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
+        w.reset()
+        s = w.state_key()
+        epsilon = 1 / (1 + (k - 1) * decay)
+        a = Policy.e_greedy_action_from_qvs(Q.index(s), epsilon, Q.values)
+        length = 0
+        delta = 0
+
+        while not w.finished:
+            reward = w.take_action(a)
+            s2 = w.state_key()
+            if w.finished:
+                a2 = 0
+                q2 = 0
+            else:
+                i2 = Q.index(s2)
+                a2 = Policy.e_greedy_action_from_qvs(i2, epsilon, Q.values)
+                q2 = Q.values[i2][a2]
+
+            i = Q.index(s)
+            change = alpha * (reward + gamma * q2 - Q.values[i][a])
+            Q.values[i][a] += change
+            Q.counts[i][a] += 1
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(change))
+
+            s = s2
+            a = a2
+
+        if callback is not None:
+            callback(k, length, w.score, epsilon, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, Q=Q)
+
+    return Q
+
 '''
 Play n games using SARSA lambda (State - Action - Reward - State - Action)
 Compute Q values using TD(lambda)
@@ -68,22 +196,35 @@ alpha : learning rate, should decrease over time
 Eligibility traces E_t(s, a)
 E_0(s, a) = 0
 E_t(s, a) = gamma * lambda * E_t(s-1, a-1) + 1(S_t = s, A_t = a)
+With replacing traces: E_t(S_t, A_t) = 1 instead of E_t-1(S_t, A_t) + 1
 
 Q(s, a) initialized arbitriraly
 err_t = R_t + gamma * Q(s_t+1, a_t+1) - Q(s_t, a_t)
 Q(s, a) = Q(s, a) + alpha * err_t * E_t(s, a)
+
+Only the (s, a) with E_t(s, a) >= cutoff are stored and updated (active set),
+so the cost of a step depends on the trace length and not on the size of the map
+callback: called after each episode (see metrics)
+step_callback: called after each step (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q (traces are empty between episodes)
 '''
-def sarsa_lambda(w, alpha, lambd, nsimus, gamma):
+def sarsa_lambda(w, alpha, lambd, nsimus, gamma, replacing = False, cutoff = 1e-4,
+                 callback = None, checkpoint = None, step_callback = None):
 
     n = w.width  * w.height
     Q = np.zeros((n, 4))
+    decay = gamma * lambd
 
-    for k in range(1, nsimus + 1):
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for k in range(start, nsimus + 1):
         w.reset()
-        E = np.zeros((n, 4))
+        #active traces: (s, a) => E(s, a)
+        E = {}
         
         s = w.player.cell.pos
         a = Policy.e_greedy_action_from_qvs(s, 1 / k, Q)
+        length = 0
+        delta = 0
         
         while not w.finished:
             reward = w.take_action(a)
@@ -91,36 +232,155 @@ def sarsa_lambda(w, alpha, lambd, nsimus, gamma):
             a2 = Policy.e_greedy_action_from_qvs(s2, 1 / k, Q)
 
             err = reward + gamma * Q[s2][a2] - Q[s][a]
-            E[s][a] += 1
-            
-            for si in range(n):
-                for ai in range(4):
-                    Q[si][ai] += alpha * err * E[si][ai]
-                    E[si][ai] *= gamma * lambd
+            if replacing:
+                E[(s, a)] = 1
+            else:
+                E[(s, a)] = E.get((s, a), 0) + 1
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(alpha * err) * max(E.values()))
+            if step_callback is not None:
+                step_callback(k, reward, abs(alpha * err) * max(E.values()))
+
+            for (si, ai), e in list(E.items()):
+                Q[si][ai] += alpha * err * e
+                e *= decay
+                if e < cutoff:
+                    del E[(si, ai)]
+                else:
+                    E[(si, ai)] = e
 
             s = s2
             a = a2
 
+        if callback is not None:
+            callback(k, length, w.score, 1 / k, delta)
+        if checkpoint is not None:
+            checkpoint.step(k, Q=Q)
+
     return Policy.build_deterministic(Policy.qvs_to_table(Q))
 
 
-def sarsa_offline(w, alpha, nsimus, gamma):
+'''
+Play n games using Q-Learning (off-policy TD(0))
+Explore following e-greedy policy, e = 1 / t
+Q(s, a) = Q(s, a) + alpha * (R + gamma * max(a') Q(s', a') - Q(s, a))
+
+Q: table updated in-place (zeros by default)
+decay: e = 1 / (1 + (t - 1) * decay), default is e = 1 / t
+callback: called after each episode (see metrics)
+step_callback: called after each step (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q
+'''
+def sarsa_offline(w, alpha, nsimus, gamma, Q = None, decay = 1, callback = None,
+                  checkpoint = None, step_callback = None):
 
     n = w.width  * w.height
-    Q = np.zeros((n, 4))
+    if Q is None:
+        Q = np.zeros((n, 4))
 
-    for t in range(1, nsimus + 1):
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for t in range(start, nsimus + 1):
         w.reset()
         s = w.player.cell.pos
-        epsilon = 1 / t
+        epsilon = 1 / (1 + (t - 1) * decay)
+        length = 0
+        delta = 0
         
         while not w.finished:
             a = Policy.e_greedy_action_from_qvs(s, epsilon, Q)
             reward = w.take_action(a)
             s2 = w.player.cell.pos
 
-            Q[s][a] += alpha * (reward + gamma * np.max(Q[s2]) - Q[s][a])
+            change = alpha * (reward + gamma * np.max(Q[s2]) - Q[s][a])
+            Q[s][a] += change
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(change))
+            if step_callback is not None:
+                step_callback(t, reward, abs(change))
+
+            s = s2
+
+        if callback is not None:
+            callback(t, length, w.score, epsilon, delta)
+        if checkpoint is not None:
+            checkpoint.step(t, Q=Q)
+
+    return Policy.build_deterministic(Policy.qvs_to_table(Q))
+
+'''
+Q-learning over full game states (world.World.state_key) instead of player positions
+Q: HashedQTable updated in-place (empty by default), returned
+Terminal states are not stored, Q(terminal, *) = 0
+callback: called after each episode (see metrics)
+checkpoint: checkpoint.Checkpointer saving Q
+'''
+def sarsa_offline_full(w, alpha, nsimus, gamma, Q = None, decay = 1, callback = None,
+                       checkpoint = None):
+
+    if Q is None:
+        Q = HashedQTable()
+
+    start = checkpoint.restore(Q=Q) if checkpoint is not None else 1
+    for t in range(start, nsimus + 1):
+        w.reset()
+        s = w.state_key()
+        epsilon = 1 / (1 + (t - 1) * decay)
+        length = 0
+        delta = 0
+
+        while not w.finished:
+            a = Policy.e_greedy_action_from_qvs(Q.index(s), epsilon, Q.values)
+            reward = w.take_action(a)
+            s2 = w.state_key()
+            q2 = 0
+            if not w.finished:
+                i2 = Q.index(s2)
+                q2 = np.max(Q.values[i2])
+
+            i = Q.index(s)
+            change = alpha * (reward + gamma * q2 - Q.values[i][a])
+            Q.values[i][a] += change
+            Q.counts[i][a] += 1
+
+            if callback is not None:
+                length += 1
+                delta = max(delta, abs(change))
 
             s = s2
 
+        if callback is not None:
+            callback(t, length, w.score, epsilon, delta)
+        if checkpoint is not None:
+            checkpoint.step(t, Q=Q)
+
+    return Q
+
+'''
+Vectorized version of sarsa_offline (Q-learning)
+Play n games on a VecWorld, all envs are updated at the same time
+Each env explores with e = 1 / t, t being the number of the game it plays
+Updates of the same (s, a) are averaged, as in policy_evaluation_td0_vec
+Q: Q values updated in-place (0 by default)
+'''
+def sarsa_offline_vec(vw, alpha, nsimus, gamma, Q = None):
+
+    n = vw.width * vw.height
+    if Q is None:
+        Q = np.zeros((n, 4))
+    envs = np.arange(vw.nenvs)
+
+    while vw.finished_games < nsimus:
+        s = vw.pos
+        epsilon = 1 / vw.episode
+        explore = vw.rng.rand(vw.nenvs) <= epsilon
+        a = np.where(explore, vw.rng.randint(0, 4, vw.nenvs), np.argmax(Q[s], axis=1))
+        s2, reward, _ = vw.take_action(a)
+
+        update = alpha * (reward + gamma * np.max(Q[s2], axis=1) - Q[s, a])
+        Q += mean_updates(s * 4 + a, update, 4 * n).reshape(n, 4)
+
     return Policy.build_deterministic(Policy.qvs_to_table(Q))
@@ -0,0 +1,214 @@
+'''
+Vectorized version of World
+Play N independent games at the same time, the whole state is stored in numpy arrays
+Same rules than world.World (slip, rewards, items, magic pill and ghosts AI),
+finished games are automatically restarted
+'''
+
+from collections import OrderedDict
+import numpy as np
+import world
+
+
+OPPOSITE_MOVES = np.array(world.ACTION_OPPOSITE)
+
+
+class VecWorld:
+
+    '''
+    path: .world file
+    nenvs: number of games played at the same time
+    seed: seed of the random generator
+    '''
+    def __init__(self, path, nenvs, seed = None):
+
+        w = world.World(path)
+        w.reset()
+        n = w.width * w.height
+
+        self.world = w
+        self.width = w.width
+        self.height = w.height
+        self.nenvs = nenvs
+        self.proba_action_valid = w.proba_action_valid
+        self.rng = np.random.RandomState(seed)
+
+        self.moves = w.moves_array
+        self.distance_cache = OrderedDict()
+        types = np.array([c.type for c in w.cells])
+        self.cell_rewards = np.array([0 if r == None else r for r in world.CELL_REWARDS])[types]
+        self.cell_end = np.array([e == True for e in world.CELL_END])[types]
+        self.start = w.start_cell.pos
+
+        # initial state of items: one item at most by cell
+        self.items_init = np.zeros(n, dtype=bool)
+        self.item_rewards = np.zeros(n)
+        self.item_magic = np.zeros(n, dtype=bool)
+        for item in w.items:
+            self.items_init[item.cell.pos] = True
+            self.item_rewards[item.cell.pos] = world.ITEM_REWARDS[item.type]
+            self.item_magic[item.cell.pos] = item.type == world.ITEM_MAGIC
+
+        # initial state of ghosts
+        ghosts = [a for a in w.agents if a.type != world.AGENT_PLAYER]
+        self.ghosts_pos_init = np.array([g.cell.pos for g in ghosts], dtype=np.int64)
+        self.ghosts_counter_init = np.array([g.counter for g in ghosts], dtype=np.int64)
+        self.ghosts_scatter_timer = np.array([world.TIMER_SCATTER[g.type] for g in ghosts],
+                                             dtype=np.int64)
+        self.ghosts_scatter_target = np.array([g.scatter_target for g in ghosts], dtype=np.int64)
+
+        nghosts = len(ghosts)
+        self.pos = np.full(nenvs, self.start, dtype=np.int64)
+        self.items = np.tile(self.items_init, (nenvs, 1))
+        self.score = np.zeros(nenvs)
+        self.magic_pill = np.zeros(nenvs, dtype=np.int64)
+        self.ghosts_pos = np.tile(self.ghosts_pos_init, (nenvs, 1))
+        self.ghosts_alive = np.ones((nenvs, nghosts), dtype=bool)
+        self.ghosts_chasing = np.zeros((nenvs, nghosts), dtype=bool)
+        self.ghosts_counter = np.tile(self.ghosts_counter_init, (nenvs, 1))
+        self.ghosts_last_move = np.full((nenvs, nghosts), -1, dtype=np.int64)
+
+        # episode[i]: number of the game currently played by env i (starts at 1)
+        self.episodes = nenvs
+        self.episode = np.arange(1, nenvs + 1)
+        self.finished_games = 0
+        self.last_scores = []
+
+    '''
+    Restart the games of all envs in mask
+    '''
+    def reset(self, mask = None):
+        if mask is None:
+            mask = np.ones(self.nenvs, dtype=bool)
+        count = np.count_nonzero(mask)
+        if count == 0:
+            return
+
+        self.pos[mask] = self.start
+        self.items[mask] = self.items_init
+        self.score[mask] = 0
+        self.magic_pill[mask] = 0
+        self.ghosts_pos[mask] = self.ghosts_pos_init
+        self.ghosts_alive[mask] = True
+        self.ghosts_chasing[mask] = False
+        self.ghosts_counter[mask] = self.ghosts_counter_init
+        self.ghosts_last_move[mask] = -1
+
+        self.episode[mask] = np.arange(self.episodes + 1, self.episodes + count + 1)
+        self.episodes += count
+
+    '''
+    Return the distances from every state to target, as a numpy array
+    Computed at the first use of each target, kept in a LRU cache of world.DISTANCE_CACHE_SIZE
+    targets as world.World.distances: only the scatter targets and the cells where the
+    players have been chased are computed
+    '''
+    def target_distances(self, target):
+        cache = self.distance_cache
+        dist = cache.get(target)
+        if dist is None:
+            dist = np.array(self.world.bfs_distances(target), dtype=np.int32)
+            cache[target] = dist
+            if len(cache) > world.DISTANCE_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(target)
+        return dist
+
+    '''
+    dist[i, j, k] = distance from next[i, j, k] to targets[i, j]
+    States are grouped by target, so each target is looked up once
+    '''
+    def distances(self, targets, next):
+        targets = targets.ravel()
+        next = next.reshape(len(targets), -1)
+        uniques, inverse = np.unique(targets, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(uniques) + 1))
+
+        dist = np.empty(next.shape)
+        for u, target in enumerate(uniques.tolist()):
+            rows = order[bounds[u]:bounds[u + 1]]
+            dist[rows] = self.target_distances(target)[next[rows]]
+        return dist.reshape(self.ghosts_pos.shape + (-1,))
+
+    '''
+    Move all ghosts of all envs, same AI than world.Agent.take_action
+    '''
+    def move_ghosts(self):
+
+        if self.ghosts_pos.shape[1] == 0:
+            return
+
+        pos = self.ghosts_pos
+        alive = self.ghosts_alive
+        frightened = (self.magic_pill != 0)[:, None]
+
+        opposite = OPPOSITE_MOVES[self.ghosts_last_move]
+        next = self.moves[pos]
+        possibles = (next != pos[:, :, None]) & (np.arange(4) != opposite[:, :, None])
+        any_possible = possibles.any(axis=2)
+
+        # frightened: random move between the possible ones
+        rand = self.rng.rand(*possibles.shape)
+        rand[~possibles] = -1
+        random_moves = np.where(any_possible, np.argmax(rand, axis=2), -1)
+
+        # scatter / chase: move closer to the target (maze distance)
+        target = np.where(self.ghosts_chasing, self.pos[:, None], self.ghosts_scatter_target)
+        dist = self.distances(target, next)
+        dist[~possibles] = np.inf
+        target_moves = np.where(any_possible, np.argmin(dist, axis=2), -1)
+        target_moves = np.where(self.ghosts_counter == 0, opposite, target_moves)
+
+        chosen = np.where(frightened, random_moves, target_moves)
+        moved = np.take_along_axis(next, np.maximum(chosen, 0)[:, :, None], axis=2)[:, :, 0]
+        self.ghosts_pos = np.where(alive & (chosen >= 0), moved, pos)
+        self.ghosts_last_move = np.where(alive, chosen, self.ghosts_last_move)
+
+        timers = alive & ~frightened
+        switch = timers & (self.ghosts_counter == 0)
+        self.ghosts_counter = np.where(switch, self.ghosts_scatter_timer,
+                                       np.where(timers, self.ghosts_counter - 1,
+                                                self.ghosts_counter))
+        self.ghosts_chasing = np.where(switch, ~self.ghosts_chasing, self.ghosts_chasing)
+
+    '''
+    Do one action in every env
+    actions: array of nenvs actions
+    Return (states reached, rewards, finished)
+    Finished games are restarted, self.pos contains the start state for them
+    '''
+    def take_action(self, actions):
+
+        envs = np.arange(self.nenvs)
+        self.magic_pill = np.maximum(self.magic_pill - 1, 0)
+        self.move_ghosts()
+
+        actions = np.asarray(actions)
+        slip = self.rng.rand(self.nenvs) >= self.proba_action_valid
+        actions = np.where(slip, self.rng.randint(0, 4, self.nenvs), actions)
+
+        pos = self.moves[self.pos, actions]
+        self.pos = pos.copy()
+        rewards = self.cell_rewards[pos].astype(np.float64)
+        finished = self.cell_end[pos].copy()
+
+        eaten = self.items[envs, pos]
+        rewards += np.where(eaten, self.item_rewards[pos], 0)
+        self.magic_pill = np.where(eaten & self.item_magic[pos], world.ITEM_MAGIC_DURATION,
+                                   self.magic_pill)
+        self.items[envs, pos] = False
+
+        met = self.ghosts_alive & (self.ghosts_pos == pos[:, None])
+        nmet = np.count_nonzero(met, axis=1)
+        killed = self.magic_pill == 0
+        rewards += np.where(killed, nmet * world.REWARD_KILLED, nmet * world.REWARD_KILL)
+        finished |= killed & (nmet > 0)
+        self.ghosts_alive &= ~(met & ~killed[:, None])
+
+        self.score += rewards
+        self.finished_games += np.count_nonzero(finished)
+        self.last_scores.extend(self.score[finished].tolist())
+        self.reset(finished)
+        return pos, rewards, finished
@@ -1,8 +1,11 @@
+from collections import OrderedDict, deque
 from utils import clamp, manhattan_dist
+import numpy as np
 import random
-import gui
 import fconfig
 
+#gui (and pygame) is only imported when rendering, the simulation works without it
+
 
 
 # GUI
@@ -10,9 +13,9 @@ WORLD_DX = 20
 WORLD_DY = 20
 CELL_SIZE = 30
 CELL_COLORS = [None,
-               gui.RED, #goal
+               (255, 0, 0), #goal
                (0, 0, 75), #wall
-               gui.YELLOW, #hole
+               (255, 255, 0), #hole
                (25, 25, 25)] #ground
 ITEM_IMGS = [None, None, None, None, None]
 ITEM_SIZE = 20
@@ -61,7 +64,7 @@ class Cell:
 
         for item in self.items:
             reward += item.get_reward()
-            self.world.items.remove(item)
+            self.world.remove_item(item)
         self.items = []
 
         for agent in self.agents:
@@ -73,7 +76,7 @@ class Cell:
                 finished = True
             else:
                 reward += REWARD_KILL
-                self.world.agents.remove(agent)
+                self.world.remove_agent(agent)
 
         if self.world.magic_pill != 0:
             self.agents = [self.world.player]
@@ -83,6 +86,7 @@ class Cell:
         return reward
 
     def render(self):
+        import gui
         gui.fill_rect(WORLD_DX + self.x * CELL_SIZE, WORLD_DY + self.y * CELL_SIZE,
                       CELL_SIZE, CELL_SIZE,
                       CELL_COLORS[self.type]);
@@ -106,6 +110,7 @@ class Item:
         self.type = type
 
     def render(self):
+        import gui
 
         x = WORLD_DX + CELL_SIZE * self.x + CELL_SIZE / 2 - ITEM_SIZE / 2
         y = WORLD_DY + CELL_SIZE * self.y + CELL_SIZE / 2 - ITEM_SIZE / 2
@@ -119,7 +124,7 @@ class Item:
     def get_reward(self):
 
         if self.type == ITEM_MAGIC:
-            self.cell.world.magic_pill = ITEM_MAGIC_DURATION
+            self.cell.world.set_magic_pill(ITEM_MAGIC_DURATION)
         
         return ITEM_REWARDS[self.type]
 
@@ -134,6 +139,7 @@ REWARD_KILLED = -500
 
 TIMER_SCATTER = [None, None, 21, 21, 15, 15]
 TIMER_CHASE = [None, None, 60, 60, 60, -1]
+TIMER_MAX = 60
 
 class Agent:
 
@@ -159,13 +165,31 @@ class Agent:
         
 
     def go_to(self, x, y):
+        w = self.cell.world
         self.x = x
         self.y = y
         self.cell.agents.remove(self)
-        self.cell = self.cell.world.get_cell(x, y)
+        w.hash ^= w.zobrist_pos[self.id][self.cell.pos]
+        self.cell = w.get_cell(x, y)
         self.cell.agents.append(self)
+        w.hash ^= w.zobrist_pos[self.id][self.cell.pos]
+
+    '''
+    Zobrist key of the mode (chase / scatter) and timer of the agent
+    Negative timers never reach 0, they are all the same state
+    '''
+    def mode_hash(self):
+        w = self.cell.world
+        return w.zobrist_mode[self.id][self.is_chasing][clamp(self.counter, -1, TIMER_MAX) + 1]
+
+    '''
+    Zobrist key of the last move of the agent (it restricts the next moves of ghosts)
+    '''
+    def move_hash(self):
+        return self.cell.world.zobrist_move[self.id][self.last_move_index()]
 
     def render(self):
+        import gui
 
         x = WORLD_DX + CELL_SIZE * self.x + CELL_SIZE / 2 - AGENT_SIZE / 2
         y = WORLD_DY + CELL_SIZE * self.y + CELL_SIZE / 2 - AGENT_SIZE / 2
@@ -180,99 +204,42 @@ class Agent:
             
         gui.draw_img(AGENT_IMGS[id], x, y)
 
-    def make_move(self, action):
+    '''
+    Index of last_move in the tables of moves, NO_MOVE if the agent never moved
+    '''
+    def last_move_index(self):
+        if self.last_move is None or self.last_move < 0:
+            return NO_MOVE
+        return self.last_move
 
+    def make_move(self, action):
         w = self.cell.world
-        sx = self.x
-        sy = self.y
-
-        oldx = sx
-        oldy = sy
-    
-        if action == ACTION_DOWN:
-            sy += 1
-        elif action == ACTION_LEFT:
-            sx -= 1
-        elif action == ACTION_RIGHT:
-            sx += 1
-        elif action == ACTION_UP:
-            sy -= 1
-
-        sx = clamp(sx, 0, w.width - 1)
-        sy = clamp(sy, 0, w.height - 1)
-
-        if w.get_cell(sx, sy).type == CELL_WALL:
-            sx = oldx
-            sy = oldy
-
-        self.go_to(sx, sy)
+        s2 = w.moves[self.cell.pos][action] if action >= 0 else self.cell.pos
+        self.go_to(s2 % w.width, s2 // w.width)
+        w.hash ^= self.move_hash()
         self.last_move = action
+        w.hash ^= self.move_hash()
 
     def is_move_change(self, action):
-
-        w = self.cell.world
-        sx = self.x
-        sy = self.y
-
-        oldx = sx
-        oldy = sy
-    
-        if action == ACTION_DOWN:
-            sy += 1
-        elif action == ACTION_LEFT:
-            sx -= 1
-        elif action == ACTION_RIGHT:
-            sx += 1
-        elif action == ACTION_UP:
-            sy -= 1
-
-        sx = clamp(sx, 0, w.width - 1)
-        sy = clamp(sy, 0, w.height - 1)
-
-        if w.get_cell(sx, sy).type == CELL_WALL:
-            sx = oldx
-            sy = oldy
-
-        return sx != oldx or sy != oldy
+        return self.cell.world.moves[self.cell.pos][action] != self.cell.pos
 
     def opposite_last(self):
-        if self.last_move == ACTION_UP:
-            return ACTION_DOWN
-        elif self.last_move == ACTION_DOWN:
-            return ACTION_UP
-        elif self.last_move == ACTION_LEFT:
-            return ACTION_RIGHT
-        else:
-            return ACTION_LEFT
+        return ACTION_OPPOSITE[self.last_move_index()]
 
+    '''
+    Return the moves that don't bang against a wall, except the reverse of the last move
+    The list is shared by all agents, it must not be modified
+    '''
     def list_possibles_moves(self):
-        res = []
-        opposite = self.opposite_last()
-        for a in range(0, 4):
-            if a != opposite and self.is_move_change(a):
-                res.append(a)
-        return res
+        return self.cell.world.ghost_moves[self.cell.pos][self.last_move_index()]
 
+    '''
+    Maze distance to state after doing action
+    '''
     def distance_to(self, action, state):
-
-        sx = self.x
-        sy = self.y
-        if action == ACTION_DOWN:
-            sy += 1
-        elif action == ACTION_LEFT:
-            sx -= 1
-        elif action == ACTION_RIGHT:
-            sx += 1
-        elif action == ACTION_UP:
-            sy -= 1
-        
         w = self.cell.world
+        return w.distances(state)[w.moves[self.cell.pos][action]]
 
-        tx = state % w.width
-        ty = state / w.width
-
-        return manhattan_dist(sx, sy, tx, ty)
-        
 
     '''
     Ghost AI :
@@ -287,7 +254,8 @@ class Agent:
     moves that doesn't bang it against a wall
     can't do reverse move
     in frightened mode, it tooks a random move against these one
-    otherwhise, it tooks the move that made him go closer to the target (manhatan distance)
+    otherwhise, it tooks the move that made him go closer to the target
+    (shortest path distance in the maze, see World.distances)
 
     Change between scatter and chase with timer, specific to each ghost
     Timer pauses when in frightened mode, and go back to previous mode when frightened over
@@ -310,18 +278,23 @@ class Agent:
             else:
                 target = self.scatter_target
 
-            best_dist = 10000
+            best_dist = float('inf')
             chosen_action = -1
             if self.counter == 0:
                 chosen_action = self.opposite_last()
             else:
+                dists = w.distances(target)
+                moves = w.moves[self.cell.pos]
                 for a in actions:
-                    dist = self.distance_to(a, target)
+                    dist = dists[moves[a]]
                     if dist < best_dist:
                         best_dist = dist
                         chosen_action = a
-        else:
+        elif actions:
             chosen_action = actions[random.randint(0, len(actions) - 1)]
+        else:
+            #dead end, frightened ghosts can't go back
+            chosen_action = -1
 
         self.make_move(chosen_action)
                     
@@ -330,6 +303,7 @@ class Agent:
 
         if w.magic_pill != 0:
             return
+        w.hash ^= self.mode_hash()
         if self.counter == 0:
             if self.is_chasing:
                 self.counter = TIMER_SCATTER[self.type]
@@ -338,12 +312,22 @@ class Agent:
             self.is_chasing = not self.is_chasing
         else:
             self.counter -= 1
+        w.hash ^= self.mode_hash()
 
 
 ACTION_UP = 0
 ACTION_DOWN = 1
 ACTION_LEFT = 2
 ACTION_RIGHT = 3
+NO_MOVE = 4
+ACTION_DX = [0, 0, -1, 1]
+ACTION_DY = [-1, 1, 0, 0]
+#reverse of each move, an agent that never moved is considered as going left
+ACTION_OPPOSITE = [ACTION_DOWN, ACTION_UP, ACTION_RIGHT, ACTION_LEFT, ACTION_LEFT]
+
+#number of targets whose distances are kept by World.distances
+#all targets are cached on small maps, only the last used ones on large maps
+DISTANCE_CACHE_SIZE = 1024
 
 class World:
 
@@ -427,9 +411,12 @@ class World:
                     self.set_cell(x, y, CELL_GROUND)
 
 
-        gui_width = WORLD_DX + self.width * (CELL_SIZE + 2)
-        gui_height = WORLD_DY + self.height * (CELL_SIZE + 2) + 50
-        gui.init(gui_width, gui_height)
+        self.gui_width = WORLD_DX + self.width * (CELL_SIZE + 2)
+        self.gui_height = WORLD_DY + self.height * (CELL_SIZE + 2) + 50
+
+        self.build_moves()
+        self.distance_cache = OrderedDict()
+        self.build_initial_state()
 
 
     def get_cell(self, x, y):
@@ -459,7 +446,92 @@ class World:
         if type == AGENT_PLAYER:
             self.player = agent
 
-    def reset(self):
+    '''
+    Compute the move tables, only once when the world is loaded
+    moves[s][a]: state you end up when doing a deterministic move a from s
+    ghost_moves[s][last_move]: moves from s that don't bang against a wall,
+    except the reverse of last_move (last_move = NO_MOVE if the agent never moved)
+    moves_array: moves as a numpy array (n, 4)
+    '''
+    def build_moves(self):
+        n = self.width * self.height
+        types = np.array([c.type for c in self.cells])
+        xs = np.arange(n) % self.width
+        ys = np.arange(n) // self.width
+
+        moves = np.zeros((n, 4), dtype=np.int64)
+        for a in range(4):
+            sx = np.clip(xs + ACTION_DX[a], 0, self.width - 1)
+            sy = np.clip(ys + ACTION_DY[a], 0, self.height - 1)
+            s2 = sy * self.width + sx
+            moves[:, a] = np.where(types[s2] == CELL_WALL, np.arange(n), s2)
+
+        self.moves_array = moves
+        self.moves = moves.tolist()
+        self.ghost_moves = [[[a for a in range(4) if a != ACTION_OPPOSITE[last] and next[a] != s]
+                             for last in range(NO_MOVE + 1)]
+                            for s, next in enumerate(self.moves)]
+
+    '''
+    Compute the shortest path distance (number of moves) from every state to target
+    with a breadth first search over the move table
+    A target in a wall is replaced by the closest reachable cells (manhattan distance)
+    Walls and states that can't reach the target have distance n = width * height
+    '''
+    def bfs_distances(self, target):
+        n = self.width * self.height
+        dist = [n] * n
+
+        if self.cells[target].type != CELL_WALL:
+            sources = [target]
+        else:
+            tx = target % self.width
+            ty = target // self.width
+            ground = [c for c in self.cells if c.type != CELL_WALL]
+            best = min([manhattan_dist(c.x, c.y, tx, ty) for c in ground] + [n])
+            sources = [c.pos for c in ground if manhattan_dist(c.x, c.y, tx, ty) == best]
+
+        for s in sources:
+            dist[s] = 0
+        queue = deque(sources)
+        while queue:
+            s = queue.popleft()
+            for s2 in self.moves[s]:
+                if dist[s2] == n:
+                    dist[s2] = dist[s] + 1
+                    queue.append(s2)
+
+        return dist
+
+    '''
+    Distance oracle: return the list of the distances from every state to target
+    Computed at the first call for each target, kept in a LRU cache of DISTANCE_CACHE_SIZE targets
+    The list is shared, it must not be modified
+    Can be used by the ghosts AI, reward shaping or features extraction
+    '''
+    def distances(self, target):
+        cache = self.distance_cache
+        dist = cache.get(target)
+        if dist is None:
+            dist = self.bfs_distances(target)
+            cache[target] = dist
+            if len(cache) > DISTANCE_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(target)
+        return dist
+
+    '''
+    Shortest path distance between states s and target
+    '''
+    def distance(self, s, target):
+        return self.distances(target)[s]
+
+    '''
+    Create all items and agents from the map description
+    Done only once, when the world is loaded, the result is kept as initial_state
+    '''
+    def build_initial_state(self):
         self.agents = []
         self.items = []
 
@@ -492,15 +564,164 @@ class World:
                 elif code == '5':
                     self.add_agent(x, y, AGENT_CLYDE)
 
+        self.add_agent(self.start_cell.x, self.start_cell.y, AGENT_PLAYER)
+
+        for i, item in enumerate(self.items):
+            item.index = i
+        for i, agent in enumerate(self.agents):
+            agent.id = i
+        self.build_zobrist()
+        self.items_mask = (1 << len(self.items)) - 1
+        self.hash = self.compute_hash()
+
+        self.initial_state = self.snapshot()
+
+    '''
+    Generate the random keys used to hash the game state (Zobrist hashing)
+    zobrist_pos[agent.id][s]: agent in state s (s = n for a killed agent)
+    zobrist_mode[agent.id][is_chasing][counter + 1]: mode and timer of agent
+    zobrist_move[agent.id][agent.last_move_index()]: last move of agent
+    zobrist_item[item.index]: item not eaten yet
+    zobrist_magic[magic_pill]: magic pill counter
+    Keys have 63 bits, so hashes fit in a signed 64 bits integer
+    '''
+    def build_zobrist(self):
+        n = self.width * self.height
+        nagents = len(self.agents)
+        rng = np.random.RandomState(0)
+
+        def keys(*shape):
+            return rng.randint(0, 2 ** 63 - 1, shape, dtype=np.int64).tolist()
+
+        self.zobrist_pos = keys(nagents, n + 1)
+        self.zobrist_mode = keys(nagents, 2, TIMER_MAX + 2)
+        self.zobrist_move = keys(nagents, NO_MOVE + 1)
+        self.zobrist_item = keys(len(self.items))
+        self.zobrist_magic = keys(ITEM_MAGIC_DURATION + 1)
+
+    '''
+    Compute the hash of the current game state from scratch
+    During the game, self.hash is updated incrementally at each change
+    '''
+    def compute_hash(self):
+        n = self.width * self.height
+        alive = set(a.id for a in self.agents)
+        h = self.zobrist_magic[self.magic_pill]
+        for agent in self.initial_agents():
+            if agent.id not in alive:
+                h ^= self.zobrist_pos[agent.id][n]
+                continue
+            h ^= self.zobrist_pos[agent.id][agent.cell.pos]
+            if agent.type != AGENT_PLAYER:
+                h ^= agent.mode_hash() ^ agent.move_hash()
+        for item in self.items:
+            h ^= self.zobrist_item[item.index]
+        return h
+
+    '''
+    Return all agents at the start of the game (including killed ones)
+    '''
+    def initial_agents(self):
+        return [a[0] for a in self.initial_state[0]] if hasattr(self, 'initial_state') else self.agents
+
+    '''
+    Hash of the full game state (player, items, ghosts with their modes and last moves, magic pill)
+    Two equal states always have the same hash
+    '''
+    def state_key(self):
+        return self.hash
+
+    '''
+    Compact encoding of the full game state:
+    (player state, bit mask of remaining items (bit i for item of index i),
+     state of each ghost (n if killed), mode of each ghost alive (True if chasing),
+     timer of each ghost alive, last move of each ghost alive (Agent.last_move_index),
+     magic pill counter)
+    '''
+    def encode_state(self):
+        n = self.width * self.height
+        all_ghosts = [a for a in self.initial_agents() if a.type != AGENT_PLAYER]
+        alive = set(a.id for a in self.agents)
+        ghosts = [g for g in all_ghosts if g.id in alive]
+        return (self.player.cell.pos,
+                self.items_mask,
+                tuple(g.cell.pos if g in ghosts else n for g in all_ghosts),
+                tuple(g.is_chasing for g in ghosts),
+                tuple(clamp(g.counter, -1, TIMER_MAX) for g in ghosts),
+                tuple(g.last_move_index() for g in ghosts),
+                self.magic_pill)
+
+    def set_magic_pill(self, val):
+        self.hash ^= self.zobrist_magic[self.magic_pill] ^ self.zobrist_magic[val]
+        self.magic_pill = val
+
+    def remove_item(self, item):
+        self.items.remove(item)
+        self.items_mask &= ~(1 << item.index)
+        self.hash ^= self.zobrist_item[item.index]
+
+    def remove_agent(self, agent):
+        n = self.width * self.height
+        self.agents.remove(agent)
+        self.hash ^= self.zobrist_pos[agent.id][agent.cell.pos] ^ self.zobrist_pos[agent.id][n]
+        self.hash ^= agent.mode_hash() ^ agent.move_hash()
+
+    '''
+    Return the full mutable state of the game
+    Items and agents objects are shared between all snapshots, only their
+    mutable fields are saved
+    '''
+    def snapshot(self):
+        agents = tuple((a, a.x, a.y, a.is_chasing, a.counter, a.last_move) for a in self.agents)
+        return (agents, tuple(self.items), self.magic_pill, self.score, self.finished,
+                self.items_mask, self.hash)
+
+    '''
+    Go back to a state returned by snapshot()
+    '''
+    def restore(self, state):
+        agents, items, magic_pill, score, finished, items_mask, hash = state
+
+        for agent in self.agents:
+            agent.cell.agents = []
+        for item in self.items:
+            item.cell.items = []
+        for item in items:
+            item.cell.items = []
+
+        self.agents = []
+        for agent, x, y, is_chasing, counter, last_move in agents:
+            agent.x = x
+            agent.y = y
+            agent.cell = self.get_cell(x, y)
+            agent.cell.agents = []
+            agent.is_chasing = is_chasing
+            agent.counter = counter
+            agent.last_move = last_move
+            self.agents.append(agent)
+        for agent in self.agents:
+            agent.cell.agents.append(agent)
+
+        self.items = list(items)
+        for item in items:
+            item.cell.items.append(item)
+
+        self.magic_pill = magic_pill
+        self.score = score
+        self.finished = finished
+        self.items_mask = items_mask
+        self.hash = hash
+
+    def reset(self):
+        self.restore(self.initial_state)
+
         if self.gui_enabled:
             self.render()
 
-        self.add_agent(self.start_cell.x, self.start_cell.y, AGENT_PLAYER)
-
     def take_action(self, action):
         reward = 0
 
-        self.magic_pill = max(self.magic_pill - 1, 0)
+        self.set_magic_pill(max(self.magic_pill - 1, 0))
 
         for agent in self.agents:
             agent.take_action()
@@ -508,28 +729,8 @@ class World:
         if random.random() >= self.proba_action_valid:
             action = random.randint(0, 3)
 
-        dx = 0
-        dy = 0
-        if action == ACTION_DOWN:
-            dy = +1
-        elif action == ACTION_LEFT:
-            dx = -1
-        elif action == ACTION_RIGHT:
-            dx = +1
-        elif action == ACTION_UP:
-            dy = -1
-
-        new_x = self.player.x + dx
-        new_y = self.player.y + dy
-
-        new_x = clamp(new_x, 0, self.width - 1)
-        new_y = clamp(new_y, 0, self.height - 1)
-
-        if not self.get_cell(new_x, new_y).is_reachable():
-            new_x = self.player.x
-            new_y = self.player.y
-
-        self.player.go_to(new_x, new_y)
+        s2 = self.moves[self.player.cell.pos][action]
+        self.player.go_to(s2 % self.width, s2 // self.width)
         reward = self.player.cell.get_reward()
 
         if self.gui_enabled:
@@ -541,7 +742,9 @@ class World:
 
 
     def render(self):
+        import gui
 
+        gui.init(self.gui_width, self.gui_height)
         gui.clear()
 
         for c in self.cells: